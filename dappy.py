@@ -21,6 +21,7 @@
 
 
 import gtk
+import gobject
 import gettext
 import os
 import sys
@@ -32,14 +33,26 @@ class Dappy():
     filename = None
     path = None
     FileHandler = None
+    autosaver = None
 
     def __init__(self, path, image_filename=None):
 
         # Initialize canvas
         self.canvas = Canvas()
         self.FileHandler = FileIO()
+        # Offer back the image of a session that crashed, unless a file was
+        # asked for. Its recovery file is then kept for the next start.
+        recovered = None
+        if image_filename == None:
+            recovered = recover()
         # Load image information
-        if image_filename != None:
+        if recovered != None:
+            self.set_current_info(recovered)
+            #the recovery file isn't where the image belongs
+            self.filename = None
+            self.path = path
+            self.canvas.modified = True
+        elif image_filename != None:
             info = self.FileHandler.read(os.path.abspath(image_filename))
             self.set_current_info(info)
         else:
@@ -47,12 +60,21 @@ class Dappy():
             self.path = path
         self.canvas.clear_overlay()
         self.canvas.print_tool()
+        #a recovered image's file is already this session's recovery file
+        self.autosaver = Autosaver(self.canvas)
 
     def set_current_info(self, image_info):
         if image_info == None:
             return
         canonical_filename = image_info[0]
-        self.canvas.set_image(image_info[1])
+        if isinstance(image_info[1], Preview):
+            #the full image is handed to the GUI's load_done later
+            self.canvas.set_preview(image_info[1])
+        else:
+            self.canvas.set_image(image_info[1])
+        if len(image_info) > 2:
+            #projects bring their undo history with them
+            self.canvas.set_undo_history(*image_info[2])
         self.fix_image_info(canonical_filename)
 
     def fix_image_info(self, canonical_filename):
@@ -69,12 +91,17 @@ if __name__ == "__main__":
     if len(sys.argv) == 2:
         filename = sys.argv[1]
 
+    # Undo compression runs on a worker thread
+    gobject.threads_init()
+
     default_path = os.getcwd()
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
     sys.path.insert(0, 'lib')
     from dappygui import GUI
     from canvas import Canvas
     from file_io import FileIO
+    from recovery import recover, Autosaver
+    from loading import Preview
     app = Dappy(default_path, filename)
     gui = GUI(app)
 
@@ -0,0 +1,178 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import cairo
+import math
+import numpy
+import pixels
+import region
+from collections import OrderedDict
+
+# Number of tinted stamps kept before the least recently used is dropped
+MAX_STAMPS = 32
+
+def tint(surface, colour, hardness=0):
+    # Use the alpha of surface as coverage of colour (a premultiplied BGRA
+    # tuple). Hardness from 0 to 1 pushes the coverage up towards a hard edge.
+    area = pixels.surface_array(surface)
+    coverage = area[:, :, 3:4].astype(numpy.uint32)
+    if hardness > 0:
+        gain = int(256/max(1.0-hardness, 1/255.0))
+        coverage = numpy.minimum((coverage*gain)>>8, 255)
+    area[...] = (coverage*numpy.array(colour, numpy.uint32)+127)//255
+    surface.mark_dirty()
+
+def stamp_size(width):
+    #stamps are whole pixels across
+    return max(int(math.ceil(width)), 1)
+
+def mip_levels(tip):
+    # The tip followed by copies of it each half the size of the one before,
+    # down to a single pixel, so stamps are never shrunk by more than half.
+    levels = [tip]
+    while max(tip.get_width(), tip.get_height()) > 1:
+        w = max(tip.get_width()//2, 1)
+        h = max(tip.get_height()//2, 1)
+        level = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        context = cairo.Context(level)
+        context.scale(float(w)/tip.get_width(), float(h)/tip.get_height())
+        context.set_source_surface(tip, 0, 0)
+        context.paint()
+        levels.append(level)
+        tip = level
+    return levels
+
+class BrushCache:
+    # Brush tips ready to be painted: each png is loaded once, as a pyramid of
+    # halved copies, and stamps of it scaled to a brush width and tinted with
+    # a colour are kept for reuse.
+    max_stamps = None
+    tips = None
+    stamps = None
+
+    def __init__(self, max_stamps=MAX_STAMPS):
+        self.max_stamps = max_stamps
+        self.tips = {}
+        self.stamps = OrderedDict()
+
+    def get_tip(self, brush, size=None):
+        #the smallest level of the tip at least size across
+        levels = self.tips.get(brush)
+        if levels is None:
+            levels = mip_levels(cairo.ImageSurface.create_from_png(brush))
+            self.tips[brush] = levels
+        if size is None:
+            return levels[0]
+        for level in reversed(levels):
+            if level.get_width() >= size:
+                return level
+        return levels[0]
+
+    def get_stamp(self, brush, color, width, hardness=0, opacity=1):
+        size = stamp_size(width)
+        rgb = (color.get_red(), color.get_green(), color.get_blue())
+        key = (brush, rgb, color.get_alpha(), size, hardness, opacity)
+        stamp = self.stamps.pop(key, None)
+        if stamp is None:
+            stamp = self.__make_stamp(brush, color, size, hardness, opacity)
+        #most recently used stamps are at the end
+        self.stamps[key] = stamp
+        while len(self.stamps) > self.max_stamps:
+            self.stamps.popitem(last=False)
+        return stamp
+
+    def __make_stamp(self, brush, color, size, hardness, opacity):
+        tip = self.get_tip(brush, size)
+        stamp = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+        context = cairo.Context(stamp)
+        scale = float(size)/tip.get_width()
+        context.scale(scale, scale)
+        context.set_source_surface(tip, 0, 0)
+        context.paint()
+        colour = [int(round(c*opacity)) for c in pixels.premultiplied_colour(color)]
+        tint(stamp, colour, hardness)
+        return stamp
+
+    def clear(self):
+        self.stamps.clear()
+
+class StampBrush:
+    # Paints strokes as dabs of a stamp spaced evenly along the path, straight
+    # onto a surface. The area each dab covers is added to damage, and passed
+    # to hold (if given) before the dab is painted.
+    cache = None
+    brush = None
+    width = None
+    spacing = None
+    hardness = None
+    opacity = None
+    stamp = None
+    context = None
+    last = None
+    to_next = None
+    damage = None
+    hold = None
+
+    def __init__(self, cache, brush, width, spacing=0.1, hardness=0, opacity=1):
+        # spacing is the distance between dabs as a fraction of the width,
+        # hardness and opacity run from 0 to 1
+        self.cache = cache
+        self.brush = brush
+        self.width = width
+        self.spacing = spacing
+        self.hardness = hardness
+        self.opacity = opacity
+        self.damage = region.Damage()
+
+    def get_step(self):
+        #dabs closer than a pixel apart would only pile up on each other
+        return max(self.spacing*self.stamp.get_width(), 1)
+
+    def begin(self, surface, color, x, y, hold=None):
+        self.stamp = self.cache.get_stamp(self.brush, color, self.width, self.hardness, self.opacity)
+        self.context = cairo.Context(surface)
+        self.hold = hold
+        self.last = (x, y)
+        self.dab(x, y)
+        self.to_next = self.get_step()
+
+    def stroke_to(self, x, y):
+        #dab along the line from the last point, carrying the distance left
+        #over on to the next call so the spacing stays even
+        lx, ly = self.last
+        dist = math.hypot(x-lx, y-ly)
+        step = self.get_step()
+        travelled = self.to_next
+        while travelled <= dist:
+            t = travelled/dist
+            self.dab(lx+(x-lx)*t, ly+(y-ly)*t)
+            travelled += step
+        self.to_next = travelled-dist
+        self.last = (x, y)
+
+    def dab(self, x, y):
+        #whole pixel positions keep the stamp from being resampled
+        size = self.stamp.get_width()
+        left = int(round(x-size/2.0))
+        top = int(round(y-size/2.0))
+        if self.hold is not None:
+            self.hold((left, top, size, size))
+        self.context.set_source_surface(self.stamp, left, top)
+        self.context.paint()
+        self.damage.add((left, top, size, size))
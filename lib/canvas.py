@@ -19,31 +19,46 @@
 
 import cairo
 import gtk
+import math
 import gobject
-from ctypes import create_string_buffer
 import tools
+import region
+import pixels
+from brushes import BrushCache
+from selection import Selection
+from mipmap import MipPyramid
+from tiles import TiledImage
+from undo import UndoHistory, UndoStep, UndoJournal, expand
 from colors import RGBAColor
 from dappygui import senstivity_data
 
-class UndoBuffer:
-    n_buf = 5
-    cur_buf = 0
-    n_buf_full = 0
-    redos_allowed = 0
-    Buffer = None
-    width = None
-    height = None
+class SurfacePool:
+    # Scratch surfaces that are kept between frames, so they are only
+    # reallocated when the canvas changes size.
+    surfaces = None
 
     def __init__(self):
-        self.Buffer = [None for i in range(self.n_buf+1)]
-        self.width = [0 for i in range(self.n_buf+1)]
-        self.height = [0 for i in range(self.n_buf+1)]
+        self.surfaces = {}
 
-    def next_buf(self):
-        return (self.cur_buf+1)%(self.n_buf+1)
+    def get(self, name, width, height, format=cairo.FORMAT_ARGB32):
+        surface = self.surfaces.get(name)
+        if surface is None or surface.get_width()!=width or surface.get_height()!=height or surface.get_format()!=format:
+            surface = cairo.ImageSurface(format, width, height)
+            self.surfaces[name] = surface
+        return surface
 
-    def prev_buf(self):
-        return (self.cur_buf-1)%(self.n_buf+1)
+    def take(self, name, width, height, format=cairo.FORMAT_ARGB32):
+        #the caller keeps the surface, so the pool must not hand it out again
+        surface = self.get(name, width, height, format)
+        del self.surfaces[name]
+        return surface
+
+    def give(self, name, surface):
+        self.surfaces[name] = surface
+
+# Range of zoom, each zoom step doubles or halves it
+MIN_ZOOM = 1/32.0
+MAX_ZOOM = 32.0
 
 class Canvas(gtk.DrawingArea):
     CORNER_SCALING_POINT = 1
@@ -52,14 +67,27 @@ class Canvas(gtk.DrawingArea):
     active_tool = None
     picker_col = None
     bg_init=None
-    undo_buffer = None
+    undo_history = None
+    undo_step = None
     select_active = None
+    selection = None
     modified = None
+    revision = None
+    preview = None
     fig_fill_type = None
     margin_size = None
     RSS = None
     primary = None
     secondary = None
+    target_fps = None
+    redraw_source = None
+    brushes = None
+    zoom = None
+    pyramid = None
+    pan_from = None
+    bottom_shadow = None
+    side_shadow = None
+    scaling_point = None
 
     def __init__(self):
         # Initializing gtk.DrawingArea superclass
@@ -69,14 +97,34 @@ class Canvas(gtk.DrawingArea):
         # Margin (to draw shadows and resize squares)
         self.margin_size = 20
         # Registering events
-        self.add_events(gtk.gdk.BUTTON_PRESS_MASK | gtk.gdk.BUTTON_RELEASE_MASK | gtk.gdk.BUTTON1_MOTION_MASK | gtk.gdk.DRAG_MOTION | gtk.gdk.POINTER_MOTION_MASK)
+        self.add_events(gtk.gdk.BUTTON_PRESS_MASK | gtk.gdk.BUTTON_RELEASE_MASK | gtk.gdk.BUTTON1_MOTION_MASK | gtk.gdk.DRAG_MOTION | gtk.gdk.POINTER_MOTION_MASK | gtk.gdk.SCROLL_MASK)
         self.connect("button-press-event", self.button_pressed)
         self.connect("button-release-event", self.button_released)
         self.connect("expose-event", self.expose)
         self.connect("motion-notify-event", self.motion_event)
+        self.connect("scroll-event", self.scroll_event)
 
-        self.undo_buffer = UndoBuffer()
+        self.undo_history = UndoHistory(call_in_main=gobject.idle_add, journal=UndoJournal())
+        # The edit in progress, its changes are merged in by commit_image
+        self.undo_step = None
         self.modified = False
+        # Counts changes to the tiles, for autosaving only when there are any
+        self.revision = 0
+        # Region of the canvas waiting to be repainted
+        self.damage = region.Damage()
+        # Part of the image drawn on since it was last copied into the tiles
+        self.pending = region.Damage()
+        self.buffers = SurfacePool()
+        # Tinted airbrush stamps, kept while the colour and width are reused
+        self.brushes = BrushCache()
+        # Repaints while drawing are held back to at most one per frame
+        self.target_fps = 60
+        self.redraw_source = None
+        # Screen pixels per image pixel, tools and damage work in image pixels
+        self.zoom = 1.0
+        # Halved copies of the image for drawing it zoomed out
+        self.pyramid = MipPyramid()
+        self.pan_from = None
 
         self.set_size(550, 412)
         self.alpha_pattern = cairo.SurfacePattern(cairo.ImageSurface.create_from_png("GUI/alpha-pattern.png"))
@@ -89,16 +137,24 @@ class Canvas(gtk.DrawingArea):
         self.figure_linewidth=0
         self.figure_corner_radius=0
         self.airbrush_width=0
+        self.airbrush_spacing=0.1
+        self.airbrush_hardness=0
+        self.airbrush_opacity=1
         self.fig_fill_type = 0
+        self.fill_tolerance = 0
+        self.fill_replace_all = False
 
-        self.set_selection(False)
-        self.select_xp = None
-        self.select_yp = None
+        self.set_selection(None)
 
         # Surface is the image in the canvas
         self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        # Image is the tiles of the surface as of the last commit_image. Only
+        # tiles that have been drawn over are copied out of the surface, see
+        # hold_tiles.
+        self.image = TiledImage(self.width, self.height)
         #overlay is for selection boxes - etc
         self.overlay = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        self.overlay_dirty = region.EMPTY
 
         #clipboard
         self.clipboard = gtk.clipboard_get(selection="CLIPBOARD")
@@ -109,6 +165,9 @@ class Canvas(gtk.DrawingArea):
         str = "GUI/tr-corner-shadow.png"
         self.TR_CORNER_SHADOW = cairo.ImageSurface.create_from_png(str)
         self.side_alpha_channels = [0.4, 0.39, 0.37, 0.32, 0.24, 0.16, 0.08, 0.04, 0.01]
+        # Decorations are drawn once and only placed on each expose
+        self.bottom_shadow, self.side_shadow = self.__make_shadows()
+        self.scaling_point = self.__make_scaling_point()
 
         self.toolchest = {
                       "draw-rounded-rectangle" : tools.RoundedRectangleTool(self),
@@ -121,11 +180,15 @@ class Canvas(gtk.DrawingArea):
                       "draw-ellipse"           : tools.EllipseTool(self),
                       "color-picker"           : tools.ColorPickerTool(self),
                       "rect-select"            : tools.RectangleSelectTool(self),
+                      "free-select"            : tools.FreeSelectTool(self),
+                      "magic-wand"             : tools.MagicWandTool(self),
+                      "zoom"                   : tools.ZoomTool(self),
                       "airbrush"               : tools.AirBrushTool(self),
+                      "floating-paste"         : tools.FloatingPasteTool(self),
                       "canvas-both-scale"      : tools.BothScalingTool(self),
                       "canvas-hor-scale"       : tools.HorizontalScalingTool(self),
                       "canvas-ver-scale"       : tools.VerticalScalingTool(self),
-                      "dummy_tool"             : tools.Tool(self)}
+                      "dummy_tool"             : tools.DummyTool(self)}
 
         self.active_tool = self.toolchest["dummy_tool"]
         self.previous_tool = self.active_tool# Previous tool (to recover from a rescale)
@@ -133,7 +196,48 @@ class Canvas(gtk.DrawingArea):
     def set_size(self, width, height):
         self.width = max(width, 1)
         self.height = max(height, 1)
-        self.set_size_request(self.width + self.margin_size, self.height + self.margin_size)
+        view_w, view_h = self.get_view_size()
+        self.set_size_request(view_w + self.margin_size, view_h + self.margin_size)
+
+    def get_view_size(self):
+        #size of the image on screen
+        return (int(math.ceil(self.width*self.zoom)), int(math.ceil(self.height*self.zoom)))
+
+    def to_view(self, rect):
+        #screen rectangle covering a rectangle of the image
+        if rect is None or self.zoom == 1:
+            return rect
+        x0 = int(math.floor(rect[0]*self.zoom))
+        y0 = int(math.floor(rect[1]*self.zoom))
+        x1 = int(math.ceil((rect[0]+rect[2])*self.zoom))
+        y1 = int(math.ceil((rect[1]+rect[3])*self.zoom))
+        return (x0, y0, x1-x0, y1-y0)
+
+    def set_zoom(self, zoom, x=None, y=None):
+        # Show the image zoom times its size, keeping the image point (x,y)
+        # at the same place in the window
+        zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        if zoom == self.zoom:
+            return
+        scroll = None
+        parent = self.get_parent()
+        if x is not None and isinstance(parent, gtk.Viewport):
+            hadj = parent.get_hadjustment()
+            vadj = parent.get_vadjustment()
+            scroll = (hadj, vadj, x*self.zoom-hadj.get_value(), y*self.zoom-vadj.get_value())
+        self.zoom = zoom
+        self.set_size(self.width, self.height)
+        if scroll is not None:
+            #the adjustments only take the new size once gtk has resized the
+            #canvas, which it does before running idle callbacks
+            gobject.idle_add(self.__scroll_to, x, y, *scroll)
+        #only the view changed, the image and its pyramid are still good
+        self.queue_draw()
+
+    def __scroll_to(self, x, y, hadj, vadj, sx, sy):
+        hadj.set_value(min(max(x*self.zoom-sx, hadj.lower), hadj.upper-hadj.page_size))
+        vadj.set_value(min(max(y*self.zoom-sy, vadj.lower), vadj.upper-vadj.page_size))
+        return False
 
     def get_width(self):
         return self.width
@@ -142,13 +246,19 @@ class Canvas(gtk.DrawingArea):
         return self.height
 
     def set_active_tool(self, toolname):
+        self.place_floating()
         self.active_tool = self.toolchest[toolname]
 
     def button_pressed(self, widget, event):
+        if event.button == 2:
+            self.__begin_pan(event)
+            return
         self.previous_tool = self.active_tool
+        x = event.x/self.zoom
+        y = event.y/self.zoom
         # When the click is outside the canvas, a scaling point might have been
         # clicked.
-        if event.x >= self.width or event.y >= self.height:
+        if x >= self.width or y >= self.height:
             sp = self.__over_scaling_point(event)
             if sp == self.CORNER_SCALING_POINT:
                 self.active_tool = self.toolchest["canvas-both-scale"]
@@ -160,20 +270,28 @@ class Canvas(gtk.DrawingArea):
                 self.active_tool = self.toolchest["dummy_tool"]
         if self.active_tool.name != 'NotSet':
             if event.type == gtk.gdk.BUTTON_PRESS:
-                self.active_tool.begin(event.x, event.y,event.button)
-                self.swap_buffers()
+                self.active_tool.begin(x, y,event.button)
+                self.swap_buffers(self.__tool_damage())
 
     def button_released(self, widget, event):
-        self.active_tool.end(event.x, event.y)
-        self.swap_buffers()
+        if event.button == 2:
+            self.pan_from = None
+            return
+        self.active_tool.end(event.x/self.zoom, event.y/self.zoom)
+        self.swap_buffers(self.__tool_damage())
         self.active_tool.commit()
-        if self.active_tool.name == "ColorPicker":
+        if self.active_tool.name == "ColorPicker" and self.active_tool.col is not None:
             col = self.active_tool.col
-            self.picker_col =  RGBAColor(col[2], col[1], col[0], col[3])
+            self.picker_col =  RGBAColor(*col)
             self.emit("color_pick_event", event)
         self.active_tool = self.previous_tool
 
     def motion_event(self, widget, event):
+        if self.pan_from is not None:
+            self.__pan(event)
+            return
+        x = event.x/self.zoom
+        y = event.y/self.zoom
         if self.active_tool.mode != self.active_tool.DRAWING:
             sp = self.__over_scaling_point(event)
             if sp != 0:
@@ -185,57 +303,221 @@ class Canvas(gtk.DrawingArea):
                     self.toolchest["canvas-ver-scale"].select()
             else:
                 self.active_tool.select()
-                if event.x > self.width or event.y > self.height:
+                if x > self.width or y > self.height:
                     self.window.set_cursor(gtk.gdk.Cursor(gtk.gdk.ARROW))
         else:
-            self.active_tool.move(event.x, event.y)
-            if self.active_tool.name == "ColorPicker":
+            self.active_tool.move(x, y)
+            if self.active_tool.name == "ColorPicker" and self.active_tool.col is not None:
                 col = self.active_tool.col
-                self.picker_col =  RGBAColor(col[2], col[1], col[0], col[3])
+                self.picker_col =  RGBAColor(*col)
                 self.emit("color_pick_event", event)
-        self.swap_buffers()
-
-    def swap_buffers(self):
-        rect = gtk.gdk.Rectangle(0, 0, self.width, self.height)
-        self.window.invalidate_rect(rect, True) #invalidating the rectangle forces gtk to run expose.
+            self.schedule_redraw(self.__tool_damage())
+
+    def scroll_event(self, widget, event):
+        #control and the wheel zooms about the pointer, otherwise it scrolls
+        if not event.state & gtk.gdk.CONTROL_MASK:
+            return False
+        if event.direction == gtk.gdk.SCROLL_UP:
+            self.set_zoom(self.zoom*2, event.x/self.zoom, event.y/self.zoom)
+        elif event.direction == gtk.gdk.SCROLL_DOWN:
+            self.set_zoom(self.zoom/2, event.x/self.zoom, event.y/self.zoom)
+        return True
+
+    def __begin_pan(self, event):
+        #dragging with the middle button moves the view
+        parent = self.get_parent()
+        if isinstance(parent, gtk.Viewport):
+            hadj = parent.get_hadjustment()
+            vadj = parent.get_vadjustment()
+            self.pan_from = (event.x_root, event.y_root, hadj.get_value(), vadj.get_value())
+
+    def __pan(self, event):
+        hadj = self.get_parent().get_hadjustment()
+        vadj = self.get_parent().get_vadjustment()
+        x_root, y_root, h, v = self.pan_from
+        hadj.set_value(min(max(h-(event.x_root-x_root), hadj.lower), hadj.upper-hadj.page_size))
+        vadj.set_value(min(max(v-(event.y_root-y_root), vadj.lower), vadj.upper-vadj.page_size))
+
+    def __tool_damage(self):
+        rect = self.active_tool.get_damage()
+        #whatever the tool repaints may end up in the image
+        if not self.active_tool.Draw2Overlay:
+            self.pending.add(rect)
+        return rect
+
+    def add_damage(self, rect=None):
+        #mark part of the canvas (None for all of it) for the next repaint
+        self.damage.add(rect)
+
+    def set_target_fps(self, fps):
+        self.target_fps = max(fps, 1)
+
+    def schedule_redraw(self, rect=None):
+        # Pointer events can come far faster than the screen refreshes, so
+        # damage is collected and repainted once when the frame is due.
+        self.damage.add(rect)
+        if self.redraw_source is None:
+            self.redraw_source = gobject.timeout_add(int(1000/self.target_fps), self.__scheduled_redraw)
+
+    def __scheduled_redraw(self):
+        self.redraw_source = None
+        self.flush_damage()
+        return False
+
+    def swap_buffers(self, rect=None):
+        self.damage.add(rect)
+        self.flush_damage()
+
+    def flush_damage(self):
+        #repaint everything damaged so far right away
+        if self.redraw_source is not None:
+            gobject.source_remove(self.redraw_source)
+            self.redraw_source = None
+        rect = region.intersect(self.damage.take(), (0, 0, self.width, self.height))
+        if not region.is_empty(rect):
+            self.pyramid.invalidate(rect)
+            #invalidating the rectangle forces gtk to run expose.
+            self.window.invalidate_rect(gtk.gdk.Rectangle(*self.to_view(rect)), True)
 
     def expose(self, widget, event): # Run when buffers are swapped: updates screen.
-        #temporary surface size of canvas
-        tmp_surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
-        context = cairo.Context(tmp_surf)
-        #draw to this temporary surface
-        self.draw(context)
-        if self.active_tool.name == "AirBrush" and  self.active_tool.mode == self.active_tool.DRAWING:
-            self.surface = tmp_surf
+        view_w, view_h = self.get_view_size()
+        exposed = (event.area.x, event.area.y, event.area.width, event.area.height)
+        area = region.intersect(exposed, (0, 0, view_w, view_h))
         #get widget window as context
         wincontext = widget.window.cairo_create()
-        #clip to image size
-        wincontext.rectangle(0, 0, self.width, self.height)
+        #clip to exposed part of the image
+        wincontext.rectangle(*area)
         wincontext.clip()
         #paint alpha pattern over whole clipped region
         wincontext.set_source(self.alpha_pattern)
         wincontext.paint()
+        if self.zoom == 1:
+            self.__expose_image(wincontext, area)
+        else:
+            self.__expose_zoomed(wincontext)
+        #decorations are outside the image, repaints inside it don't reach them
+        if area != exposed:
+            context = widget.window.cairo_create()
+            context.set_fill_rule(cairo.FILL_RULE_EVEN_ODD)
+            context.rectangle(*exposed)
+            context.rectangle(*area)
+            context.clip()
+            context.set_fill_rule(cairo.FILL_RULE_WINDING)
+            self.__draw_shadows(context)
+            self.__draw_scaling_points(context)
+
+    def __expose_image(self, wincontext, area):
+        #back buffer size of canvas, kept from the last frame
+        tmp_surf = self.buffers.get("expose", self.width, self.height)
+        context = cairo.Context(tmp_surf)
+        #only recomposite the exposed part of the image
+        context.rectangle(*area)
+        context.clip()
+        #wipe the last frame from the part being redrawn
+        context.set_operator(cairo.OPERATOR_CLEAR)
+        context.paint()
+        context.set_operator(cairo.OPERATOR_OVER)
+        #draw to the back buffer
+        self.draw(context)
+        if self.preview is not None:
+            self.__draw_preview(context)
         #paint
         wincontext.set_source_surface(tmp_surf)
         wincontext.paint()
         #overlay
         wincontext.set_source_surface(self.overlay)
         wincontext.paint()
-        # Retrieving cairo context
-        context = widget.window.cairo_create()
-        # Modify clipping area to draw decorations outside the canvas
-        # Draw decorations
-        self.__draw_shadows(context)
-        self.__draw_scaling_points(context)
+
+    def __expose_zoomed(self, wincontext):
+        # Everything is drawn in image pixels scaled to the screen, the clip
+        # keeps the work to the image under the exposed area. The group is
+        # the back buffer, only as big as that area.
+        wincontext.push_group()
+        wincontext.scale(self.zoom, self.zoom)
+        self.__draw_background(wincontext)
+        if self.preview is not None:
+            #the image is blank underneath
+            self.__draw_preview(wincontext)
+        elif self.zoom < 1:
+            #shrink a level of the pyramid by no more than half
+            level, scale = self.pyramid.get_level(self.surface, self.zoom)
+            wincontext.save()
+            wincontext.scale(scale, scale)
+            wincontext.set_source_surface(level)
+            wincontext.get_source().set_filter(cairo.FILTER_GOOD)
+            wincontext.paint()
+            wincontext.restore()
+        else:
+            #show the pixels as squares when zoomed in
+            wincontext.set_source_surface(self.surface)
+            wincontext.get_source().set_filter(cairo.FILTER_NEAREST)
+            wincontext.paint()
+        self.draw_tool(wincontext)
+        wincontext.set_source_surface(self.overlay)
+        wincontext.get_source().set_filter(cairo.FILTER_NEAREST)
+        wincontext.paint()
+        wincontext.pop_group_to_source()
+        wincontext.paint()
+
+    def __draw_preview(self, context):
+        #the draft scaled up to the image's size
+        context.save()
+        context.scale(float(self.width)/self.preview.get_width(), float(self.height)/self.preview.get_height())
+        context.set_source_surface(self.preview, 0, 0)
+        context.get_source().set_extend(cairo.EXTEND_PAD)
+        context.paint()
+        context.restore()
 
     def print_tool(self):
+        if self.preview is not None:
+            #nothing is drawn on an image still being decoded
+            return
         self.clear_overlay()
-        #temporary surface size of canvas
-        tmp_surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
-        context = cairo.Context(tmp_surf)
-        #draw to temporary surface
-        self.draw(context)
-        self.surface = tmp_surf #surface now swapped with updated surface
+        w = self.surface.get_width()
+        h = self.surface.get_height()
+        if self.bg_init==1 and w==self.width and h==self.height:
+            #same size, so the tool can be drawn straight onto the image
+            rect = self.pending.take()
+            self.hold_tiles(rect)
+            context = cairo.Context(self.surface)
+            if rect is not None:
+                #only the held tiles may change, whatever a tool's damage
+                #leaves out would miss the tiles and undo
+                context.rectangle(*rect)
+                context.clip()
+            self.draw_tool(context)
+        else:
+            #tiles the new size cuts into can't be read once it is swapped
+            self.image.hold_edges(self.width, self.height)
+            #temporary surface size of canvas
+            tmp_surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+            context = cairo.Context(tmp_surf)
+            #draw to temporary surface
+            self.draw(context)
+            self.surface = tmp_surf #surface now swapped with updated surface
+            self.image.set_source(tmp_surf)
+            self.pending.take()
+            rect = None
+        self.commit_image(rect)
+
+    def commit_image(self, rect=None):
+        # Copy the part of the surface that was drawn on (None for all of it)
+        # into the tiles, returning the tiles that changed.
+        changes = self.image.read_surface(self.surface, rect)
+        self.pyramid.invalidate(rect)
+        if changes:
+            self.revision += 1
+        if self.undo_step is not None:
+            was_empty = self.undo_step.is_empty()
+            self.undo_step.merge(changes, self.image.get_size())
+            if was_empty and not self.undo_step.is_empty():
+                self.undo_history.push(self.undo_step)
+                self.emit("change_sensitivty", senstivity_data('undo',True))
+                self.emit("change_sensitivty", senstivity_data('redo',False))
+            elif not was_empty:
+                self.undo_history.update()
+            self.undo_history.compress_old(self.image)
+        return changes
 
     def draw(self, context):
         # Drawing the background
@@ -243,10 +525,14 @@ class Canvas(gtk.DrawingArea):
         #Draw the current surface over the background
         context.set_source_surface(self.surface)
         context.paint()
+        self.draw_tool(context)
+
+    def draw_tool(self, context):
         #Draw any active tool if applicable.
         if self.active_tool.Draw2Overlay:
             ov_context = cairo.Context(self.overlay)
             self.active_tool.draw(ov_context)
+            self.overlay_dirty = region.union(self.overlay_dirty, self.active_tool.get_bounds())
         else:
             self.active_tool.draw(context)
 
@@ -263,18 +549,28 @@ class Canvas(gtk.DrawingArea):
         context.fill()
 
     def clear_overlay(self):
-        #temporary surface size of canvase
-        tmp_surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
-        context= cairo.Context(tmp_surf)
-        #paint surface transparent
-        context.rectangle(0, 0, self.width, self.height)
-        context.set_source_rgba(0, 0, 0, 0)
-        context.fill()
-        #set as overlay
-        self.overlay = tmp_surf
-        self.set_selection(False)
-
-    def set_selection(self,value):
+        if self.overlay.get_width()!=self.width or self.overlay.get_height()!=self.height:
+            #new surfaces start transparent
+            self.overlay = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        elif not region.is_empty(self.overlay_dirty):
+            #only wipe the part that has been drawn on
+            context= cairo.Context(self.overlay)
+            if self.overlay_dirty is not None:
+                context.rectangle(*self.overlay_dirty)
+                context.clip()
+            context.set_operator(cairo.OPERATOR_CLEAR)
+            context.paint()
+        #the old selection box has to be wiped from the screen
+        self.add_damage(self.overlay_dirty)
+        self.overlay_dirty = region.EMPTY
+        self.set_selection(None)
+
+    def set_selection(self, selection):
+        #selection is a Selection, None or an empty one selects nothing
+        if selection is not None and selection.is_empty():
+            selection = None
+        self.selection = selection
+        value = selection is not None
         if self.select_active != value:
             self.select_active = value
             self.emit("change_sensitivty", senstivity_data('crop',value))
@@ -282,282 +578,321 @@ class Canvas(gtk.DrawingArea):
     def get_image(self):
         return self.surface
 
+    def snapshot(self, place=True):
+        # The image as it is now, for saving in the background. Only the tile
+        # index is copied, so later edits replace tiles without touching it.
+        # Unless place is False a floating paste is placed first.
+        if place:
+            self.place_floating()
+        return self.image.copy()
+
+    def get_revision(self):
+        return self.revision
+
+    def hold_tiles(self, rect=None):
+        # Anything drawing straight onto the surface calls this first with
+        # the area it will draw on (None for all of it), so the tiles there
+        # are read while they are still as they were
+        self.image.hold(rect)
+
+    def snapshot_history(self):
+        return self.undo_history.snapshot()
+
     def set_image(self, surface):
+        self.preview = None
         self.surface = surface
         self.set_size(surface.get_width(), surface.get_height())
+        #nothing is copied until it is drawn over
+        self.image = TiledImage.over_surface(surface)
+        self.revision += 1
+        #the history holds tiles of the old image
+        self.clear_undo_buffer()
+
+    def set_preview(self, preview):
+        # Show a Preview until set_image is given the image. The image is
+        # left blank meanwhile, a new surface costs no memory until it is
+        # drawn on.
+        self.set_image(cairo.ImageSurface(cairo.FORMAT_ARGB32, preview.width, preview.height))
+        self.preview = preview.surface
+
+    def is_preview(self):
+        return self.preview is not None
+
+    def end_preview(self, keep=False):
+        # Stop showing a preview whose image isn't coming, keeping the draft
+        # scaled up as the image if keep is True
+        if self.preview is None:
+            return
+        if keep:
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+            self.__draw_preview(cairo.Context(surface))
+            self.set_image(surface)
+        else:
+            self.preview = None
+        self.swap_buffers()
+
+    def set_undo_history(self, steps, redos):
+        #a history saved with the image, set_image must come first
+        self.undo_history.restore(steps, redos)
+        self.emit("change_sensitivty", senstivity_data('undo', self.undo_history.can_undo()))
+        self.emit("change_sensitivty", senstivity_data('redo', self.undo_history.can_redo()))
 
     def get_color(self):#used by color_pick_event callback
         return self.picker_col
 
     def undo(self):
-        if self.undo_buffer.n_buf_full>0:
+        self.place_floating()
+        if self.undo_history.can_undo():
             self.modified=True
-            self.update_undo_buffer(0)
-            buf = self.undo_buffer.prev_buf()
-            data = self.surface.get_data()
-            w = self.surface.get_width()
-            h = self.surface.get_height()
-            bw = self.undo_buffer.width[buf]
-            bh = self.undo_buffer.height[buf]
-            if bh!=h | bw!=w:
-                self.set_size(bw,bh)
-                self.print_tool()
-                data = self.surface.get_data()
-            data[:] = self.undo_buffer.Buffer[buf][:]
-            self.undo_buffer.n_buf_full -=1
-            if self.undo_buffer.redos_allowed<self.undo_buffer.n_buf:
-                self.undo_buffer.redos_allowed += 1
-            self.undo_buffer.cur_buf = buf
-            self.swap_buffers()
+            self.undo_step = None
+            step = self.undo_history.undo()
+            self.__restore_tiles(step.before, step.before_size)
             self.emit("change_sensitivty", senstivity_data('redo',True))
-            if self.undo_buffer.n_buf_full==0:
+            if not self.undo_history.can_undo():
                 self.emit("change_sensitivty", senstivity_data('undo',False))
 
     def redo(self):
-        if self.undo_buffer.redos_allowed>0:
+        self.place_floating()
+        if self.undo_history.can_redo():
             self.modified=True
-            buf = self.undo_buffer.next_buf()
-            data = self.surface.get_data()
-            w = self.surface.get_width()
-            h = self.surface.get_height()
-            bw = self.undo_buffer.width[buf]
-            bh = self.undo_buffer.height[buf]
-            if bh!=h | bw!=w:
-                self.set_size(bw,bh)
-                self.print_tool()
-                data = self.surface.get_data()
-            data[:] = self.undo_buffer.Buffer[buf][:]
-            self.undo_buffer.redos_allowed -=1
-            self.undo_buffer.n_buf_full +=1
-            self.undo_buffer.cur_buf = buf
-            self.swap_buffers()
+            self.undo_step = None
+            step = self.undo_history.redo()
+            self.__restore_tiles(step.after, step.after_size)
             self.emit("change_sensitivty", senstivity_data('undo',True))
-            if self.undo_buffer.redos_allowed==0:
+            if not self.undo_history.can_redo():
                 self.emit("change_sensitivty", senstivity_data('redo',False))
 
-    def update_undo_buffer(self,iterate):
+    def __restore_tiles(self, tiles, size):
+        self.image.resize(*size)
+        self.revision += 1
+        for key, tile in tiles.iteritems():
+            self.image.set_tile(key, expand(tile))
+        if (self.surface.get_width(), self.surface.get_height()) != size:
+            #the surface has to be rebuilt at the old size
+            self.surface = self.image.to_surface()
+            self.image.set_source(self.surface)
+            self.set_size(*size)
+            self.swap_buffers()
+        else:
+            inside = set(self.image.keys_in_rect(None))
+            keys = [key for key in tiles if key in inside]
+            self.image.write_surface(self.surface, keys)
+            rect = region.EMPTY
+            for key in keys:
+                rect = region.union(rect, self.image.tile_rect(key))
+            self.swap_buffers(rect)
+
+    def begin_undo_step(self):
+        #cheap: tiles are only read out of the surface as it is drawn over
         self.modified=True
-        w = self.surface.get_width()
-        h = self.surface.get_height()
-        s = self.surface.get_stride()
-        data = self.surface.get_data()
-        buf = self.undo_buffer.cur_buf
-        self.undo_buffer.Buffer[buf] = create_string_buffer(s*h)
-        self.undo_buffer.Buffer[buf][:] = data[:]
-        self.undo_buffer.width[buf] = w
-        self.undo_buffer.height[buf] = h
-        if iterate==1:
-            self.emit("change_sensitivty", senstivity_data('undo',True))
-            self.emit("change_sensitivty", senstivity_data('redo',False))
-            self.undo_buffer.redos_allowed = 0
-            if self.undo_buffer.n_buf_full<self.undo_buffer.n_buf:
-                self.undo_buffer.n_buf_full += 1
-            self.undo_buffer.cur_buf = self.undo_buffer.next_buf()
+        self.undo_step = UndoStep(self.image.get_size())
 
     def clear_undo_buffer(self):
         self.emit("change_sensitivty", senstivity_data('undo',False))
         self.emit("change_sensitivty", senstivity_data('redo',False))
-        self.undo_buffer.cur_buf = 0
-        self.undo_buffer.n_buf_full = 0
-        self.undo_buffer.redos_allowed = 0
+        self.undo_history.clear()
+        self.undo_step = None
+
+    def get_selection(self):
+        #the selection clipped to the image, or all of the image
+        rect = (0, 0, self.surface.get_width(), self.surface.get_height())
+        if self.selection is None:
+            return Selection.from_rect(rect)
+        return self.selection.clip(rect)
+
+    def get_selection_rect(self):
+        return self.get_selection().get_bounds()
 
     def copy(self,cut):
-        data = self.surface.get_data()
-        t_data=list(data)
-        t_data[::4] = data[2::4]
-        t_data[2::4] = data[::4]
-        s = self.surface.get_stride()
-        w = self.surface.get_width()
-        h = self.surface.get_height()
-        if self.select_active:
-            xp= [min(max(0,x),w) for x in self.select_xp]
-            yp= [min(max(0,y),h) for y in self.select_yp]
-            c_w= int(max(xp)-min(xp))
-            c_h= int(max(yp)-min(yp))
-            if c_h>0 and c_w>0:
-                c_s = c_w*4
-                c_data=[t_data[0]]*(c_h*c_s)
-                c_y = int(min(yp))
-                c_x = int(min(xp))
-                for n in range(c_h):
-                    c_data[n*c_s:(n+1)*c_s] = t_data[(n+c_y)*s+c_x*4:(n+c_y)*s+c_x*4+c_s]
-                c_data = ''.join(c_data)
-                PixBuf =  gtk.gdk.pixbuf_new_from_data(c_data,gtk.gdk.COLORSPACE_RGB, True, 8, c_w,c_h,c_s)
-                self.clipboard.set_image(PixBuf)
-                if cut:
-                    self.delete()
-        else:
-            t_data = ''.join(t_data)
-            PixBuf =  gtk.gdk.pixbuf_new_from_data(t_data,gtk.gdk.COLORSPACE_RGB, True, 8, w,h,s)
-            self.clipboard.set_image(PixBuf)
-            if cut:
-                self.delete()
+        sel = self.get_selection()
+        if sel.is_empty():
+            return
+        rect = sel.get_bounds()
+        #pixbufs want straight RGBA, only the selection is converted and it
+        #comes out as one contiguous block
+        rgba = pixels.unpremultiply(pixels.surface_array(self.surface, rect))
+        if not sel.is_rect():
+            #leave out the pixels around the selection
+            rgba[~sel.to_mask()] = 0
+        c_w = rect[2]
+        c_h = rect[3]
+        PixBuf =  gtk.gdk.pixbuf_new_from_data(rgba.tostring(),gtk.gdk.COLORSPACE_RGB, True, 8, c_w,c_h,c_w*4)
+        self.clipboard.set_image(PixBuf)
+        if cut:
+            self.delete()
 
     def delete(self):
-        w = self.surface.get_width()
-        h = self.surface.get_height()
-        if self.select_active:
-            xp= [min(max(0,x),w) for x in self.select_xp]
-            yp= [min(max(0,y),h) for y in self.select_yp]
-            c_w= int(max(xp)-min(xp))
-            c_h= int(max(yp)-min(yp))
-            if c_h>0 and c_w>0:
-                c_y = int(min(yp))
-                c_x = int(min(xp))
-                self.update_undo_buffer(1)
-                aux = cairo.ImageSurface(cairo.FORMAT_ARGB32, c_w, c_h)
-                context  = cairo.Context(aux)
-                context.rectangle(0, 0, self.width, self.height)
-                context.set_source_rgba(self.secondary.get_red(),self.secondary.get_green(),self.secondary.get_blue(),self.secondary.get_alpha())
-                context.fill()
-                mask = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
-                context  = cairo.Context(mask)
-                context.rectangle(0, 0, self.width, self.height)
-                context.set_source_rgba(1,1,1,0)
-                context.fill()
-                context.rectangle(c_x, c_y, c_w, c_h)
-                context.set_source_rgba(1,1,1,1)
-                context.fill()
-                context = cairo.Context(self.surface)
-                context.set_source_surface(aux, c_x, c_y)
-                context.set_operator(cairo.OPERATOR_SOURCE)
-                context.mask(cairo.SurfacePattern(mask))
-                self.swap_buffers()
+        sel = self.get_selection()
+        if sel.is_empty():
+            return
+        rect = sel.get_bounds()
+        self.begin_undo_step()
+        self.hold_tiles(rect)
+        #replace just the selection with the secondary colour
+        context  = cairo.Context(self.surface)
+        context.rectangle(*rect)
+        context.clip()
+        context.set_source_rgba(self.secondary.get_red(),self.secondary.get_green(),self.secondary.get_blue(),self.secondary.get_alpha())
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        if sel.is_rect():
+            context.paint()
         else:
-            data = self.surface.get_data()
-            self.update_undo_buffer(1)
-            context  = cairo.Context(self.surface)
-            context.rectangle(0, 0, self.width, self.height)
-            context.set_source_rgba(self.secondary.get_red(),self.secondary.get_green(),self.secondary.get_blue(),self.secondary.get_alpha())
-            context.set_operator(cairo.OPERATOR_SOURCE)
-            context.fill()
-            #if the context is filled blank the pixels wont edit properly for bucket fill
-            #The hacky solution is to copy the black pixels to a temporary array
-            #Paint new pixels, and then copy the blank ones back in.
-            if self.secondary.get_alpha() == 0:
-                t_data = data[:]
-                context = cairo.Context(self.surface)
-                context.paint()
-                data[:] = t_data[:]
-            self.swap_buffers()
+            context.mask_surface(sel.to_surface(), rect[0], rect[1])
+        self.commit_image(rect)
+        self.swap_buffers(rect)
 
     def paste(self):
-        image = self.clipboard.wait_for_image()
-        if image != None:
-            self.update_undo_buffer(1)
-            self.set_size(max(self.width,image.get_width()), max(self.height,image.get_height()))
-            self.print_tool()
-            aux = cairo.ImageSurface(cairo.FORMAT_ARGB32, image.get_width(), image.get_height())
-            im_data = image.get_pixels()
-            # the next two semingly useless lines give the surface real pixels to be edited.
-            context = cairo.Context(aux)
-            context.paint()
-            #directly write to the pixels in aux
-            data = aux.get_data()
-            #pasted image has alpha channel
-            if image.get_rowstride()==aux.get_stride():
-                data[2::4] = im_data[0::4]#red
-                data[0::4] = im_data[2::4] #blue
-                data[1::4] = im_data[1::4] #green
-                data[3::4] = im_data[3::4] #alpha
-            else: #pasted data no alpha channel
-                data[2::4] = im_data[0::3]#red
-                data[0::4] = im_data[2::3] #blue
-                data[1::4] = im_data[1::3] #green
-            #use cairo to add the pasted image to the current image
-            context = cairo.Context(self.surface)
-            context.set_source_surface(aux, 0, 0)
-            context.paint()
-            self.swap_buffers()
+        #the image is handed over later, so the main loop keeps running while
+        #a large clipboard is transferred
+        self.clipboard.request_image(self.__pasted)
+
+    def __pasted(self, clipboard, image, data=None):
+        if image == None:
+            return
+        self.place_floating()
+        rgba = pixels.pixbuf_array(image)
+        layer = pixels.new_surface(pixels.premultiply(rgba))
+        #float it over the selection, or the top left corner
+        if self.select_active:
+            x, y = self.get_selection_rect()[:2]
+        else:
+            x, y = 0, 0
+        tool = self.toolchest["floating-paste"]
+        tool.hold(layer, x, y, self.active_tool)
+        self.active_tool = tool
+        self.previous_tool = tool
+        self.clear_overlay()
+        self.swap_buffers(tool.get_damage())
+
+    def place_floating(self):
+        #paint any floating paste into the image
+        if self.active_tool.name == 'FloatingPaste':
+            tool = self.active_tool
+            tool.place()
+            self.active_tool = tool.resume_tool
+            self.previous_tool = self.active_tool
+            self.swap_buffers(tool.get_damage())
 
     def crop(self):
-        if self.select_active:
-            self.update_undo_buffer(1)
-            w = self.surface.get_width()
-            h = self.surface.get_height()
-            xp= [min(max(0,x),w) for x in self.select_xp]
-            yp= [min(max(0,y),h) for y in self.select_yp]
-            c_w= int(max(xp))-int(min(xp))
-            c_h= int(max(yp))-int(min(yp))
-            aux = cairo.ImageSurface(cairo.FORMAT_ARGB32, w,h)
-            context = cairo.Context(aux)
-            context.set_source_surface(self.surface,0,0)
+        if not self.select_active:
+            return
+        sel = self.get_selection()
+        if sel.is_empty():
+            return
+        self.begin_undo_step()
+        #every tile moves, so all of them are needed for undo
+        self.hold_tiles()
+        c_x, c_y, c_w, c_h = sel.get_bounds()
+        #the new image is made from the selected part only, anything around
+        #a free form selection is left transparent
+        cropped = cairo.ImageSurface(cairo.FORMAT_ARGB32, c_w, c_h)
+        context = cairo.Context(cropped)
+        context.set_source_surface(self.surface, -c_x, -c_y)
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        if sel.is_rect():
             context.paint()
-            context = cairo.Context(self.surface)
-            context.set_source_surface(aux,-int(min(xp)),-int(min(yp)))
-            context.paint()
-            self.set_size(c_w,c_h)
-            self.clear_overlay()
-            self.print_tool()
+        else:
+            context.mask_surface(sel.to_surface(), 0, 0)
+        self.surface = cropped
+        self.set_size(c_w,c_h)
+        self.clear_overlay()
+        self.commit_image()
+        self.swap_buffers()
 
     def is_modified(self):
         return self.modified
 
     def __draw_shadows(self, context):
+        width, height = self.get_view_size()
         # Shadow displacements
         disp = 2
         csw = self.BL_CORNER_SHADOW.get_width()
 
-        if self.width > 10:
+        if width > 10:
             # Bottom left corner
-            context.set_source_surface(self.BL_CORNER_SHADOW, disp, self.height)
+            context.set_source_surface(self.BL_CORNER_SHADOW, disp, height)
             context.paint()
 
             # Bottom shadow
-            context.translate(0, self.height)
-            for i in range(len(self.side_alpha_channels)):
-                alpha = self.side_alpha_channels[i]
-                context.rectangle(disp+csw, i, self.width-disp-csw, 1)
-                context.set_source_rgba(0, 0, 0, alpha)
-                context.fill()
-            context.translate(0, -self.height)
-
-        if self.height > 10:
+            context.translate(0, height)
+            context.rectangle(disp+csw, 0, width-disp-csw, len(self.side_alpha_channels))
+            context.set_source(self.bottom_shadow)
+            context.fill()
+            context.translate(0, -height)
+
+        if height > 10:
             # Top right corner
-            context.set_source_surface(self.TR_CORNER_SHADOW, self.width, disp)
+            context.set_source_surface(self.TR_CORNER_SHADOW, width, disp)
             context.paint()
 
             # Side shadow
-            context.translate(self.width, 0)
-            for i in range(len(self.side_alpha_channels)):
-                alpha = self.side_alpha_channels[i]
-                context.rectangle(i, disp+csw, 1, self.height-disp-csw)
-                context.set_source_rgba(0, 0, 0, alpha)
-                context.fill()
-            context.translate(-self.width, 0)
+            context.translate(width, 0)
+            context.rectangle(0, disp+csw, len(self.side_alpha_channels), height-disp-csw)
+            context.set_source(self.side_shadow)
+            context.fill()
+            context.translate(-width, 0)
+
+    def __make_shadows(self):
+        #one pixel slices across the bottom and side shadows, repeated along them
+        n = len(self.side_alpha_channels)
+        bottom = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, n)
+        side = cairo.ImageSurface(cairo.FORMAT_ARGB32, n, 1)
+        bottom_context = cairo.Context(bottom)
+        side_context = cairo.Context(side)
+        for i in range(n):
+            alpha = self.side_alpha_channels[i]
+            bottom_context.rectangle(0, i, 1, 1)
+            bottom_context.set_source_rgba(0, 0, 0, alpha)
+            bottom_context.fill()
+            side_context.rectangle(i, 0, 1, 1)
+            side_context.set_source_rgba(0, 0, 0, alpha)
+            side_context.fill()
+        patterns = (cairo.SurfacePattern(bottom), cairo.SurfacePattern(side))
+        for pattern in patterns:
+            pattern.set_extend(cairo.EXTEND_REPEAT)
+        return patterns
 
     def __draw_scaling_points(self, context):
+        width, height = self.get_view_size()
         # Right scaling point
-        if self.height > self.RSS*4:
-            self.__draw_scaling_point(context, self.width,(self.height-self.RSS)/2)
+        if height > self.RSS*4:
+            self.__draw_scaling_point(context, width,(height-self.RSS)/2)
         # Bottom scaling point
-        if self.width > self.RSS*4:
-            self.__draw_scaling_point(context, (self.width-self.RSS)/2,self.height)
+        if width > self.RSS*4:
+            self.__draw_scaling_point(context, (width-self.RSS)/2,height)
         # Corner scaling point
-        self.__draw_scaling_point(context, self.width, self.height)
+        self.__draw_scaling_point(context, width, height)
 
     def __draw_scaling_point(self, context, x, y):
+        context.set_source_surface(self.scaling_point, x, y)
+        context.paint()
+
+    def __make_scaling_point(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.RSS, self.RSS)
+        context = cairo.Context(surface)
         # Dark border
         context.set_source_rgba(0.156, 0.402, 0546, 1)
-        context.rectangle(x+1, y+1, self.RSS-1, self.RSS-1)
+        context.rectangle(1, 1, self.RSS-1, self.RSS-1)
         context.fill()
         # Light border
         context.set_source_rgba(.556, .802, .946, 1)
-        context.rectangle(x, y, self.RSS-1, self.RSS-1)
+        context.rectangle(0, 0, self.RSS-1, self.RSS-1)
         context.fill()
         # The point itself
         context.set_source_rgba(.26,.67,.91,1.0)
-        context.rectangle(x+1, y+1, self.RSS-2, self.RSS-2)
+        context.rectangle(1, 1, self.RSS-2, self.RSS-2)
         context.fill()
+        return surface
 
     def __over_scaling_point(self, event):
-        if self.width < event.x+1 < self.width + self.RSS:
-            if self.height < event.y+1 < self.height + self.RSS:
+        width, height = self.get_view_size()
+        if width < event.x+1 < width + self.RSS:
+            if height < event.y+1 < height + self.RSS:
                 return self.CORNER_SCALING_POINT
-            elif (self.height-self.RSS)/2 < event.y+1 < (self.height+self.RSS)/2:
+            elif (height-self.RSS)/2 < event.y+1 < (height+self.RSS)/2:
                 return self.RIGHT_SCALING_POINT
-        elif self.height < event.y+1 < self.height + self.RSS:
-            if (self.width-self.RSS)/2 < event.x+1 < (self.width+self.RSS)/2:
+        elif height < event.y+1 < height + self.RSS:
+            if (width-self.RSS)/2 < event.x+1 < (width+self.RSS)/2:
                 return self.BOTTOM_SCALING_POINT
         return 0
 
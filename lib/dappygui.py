@@ -22,6 +22,7 @@
 
 # Import packages
 import gtk
+import os
 import gettext
 
 from colors import ColorCell
@@ -42,6 +43,7 @@ class GUI():
     TB_FIGURE=1
     TB_AIRBRUSH=2
     TB_SELECTION=3
+    TB_FILL=4
 
     def __init__(self, dappy):
         self.DAPPY = dappy
@@ -63,6 +65,18 @@ class GUI():
         self.toolbar = self.builder.get_object("toolbar")
         self.toolbar.set_style(gtk.TOOLBAR_ICONS)
 
+        # Saves run in the background and report to the status bar
+        self.statusbar = self.builder.get_object("statusbar")
+        self.save_context = self.statusbar.get_context_id("save")
+        self.DAPPY.FileHandler.set_save_callbacks(self.save_progress, self.save_done)
+        # Big images open from a preview, editing waits for the full image
+        self.load_context = self.statusbar.get_context_id("load")
+        self.DAPPY.FileHandler.set_load_callbacks(self.load_progress, self.load_done)
+        # Autosaves only show up when they fail
+        self.autosave_context = self.statusbar.get_context_id("autosave")
+        self.DAPPY.autosaver.set_status_callback(self.autosave_status)
+        self.DAPPY.canvas.set_sensitive(not self.DAPPY.FileHandler.is_loading())
+
         # Initialize palette
         self.__init_colors(self.builder.get_object("colors-grid"))
 
@@ -91,6 +105,7 @@ class GUI():
         self.cntxt_toolbars.append(self.builder.get_object("figure-toolbar"))
         self.cntxt_toolbars.append(self.builder.get_object("airbrush-toolbar"))
         self.cntxt_toolbars.append(self.builder.get_object("select-toolbar"))
+        self.cntxt_toolbars.append(self.builder.get_object("fill-toolbar"))
 
 
         #Fix spinners
@@ -103,6 +118,19 @@ class GUI():
         self.airb_w = self.builder.get_object("airbrush-width")
         self.airb_w .set_value(self.airb_w .get_value())
         self.DAPPY.canvas.airbrush_width=self.airb_w.get_value()
+        airb_s = self.builder.get_object("airbrush-spacing")
+        airb_s.set_value(airb_s.get_value())
+        self.DAPPY.canvas.airbrush_spacing=airb_s.get_value()/100.0
+        airb_h = self.builder.get_object("airbrush-hardness")
+        airb_h.set_value(airb_h.get_value())
+        self.DAPPY.canvas.airbrush_hardness=airb_h.get_value()/100.0
+        airb_o = self.builder.get_object("airbrush-opacity")
+        airb_o.set_value(airb_o.get_value())
+        self.DAPPY.canvas.airbrush_opacity=airb_o.get_value()/100.0
+        self.wand_tol = self.builder.get_object("wand-tolerance")
+        fill_tol = self.builder.get_object("fill-tolerance")
+        fill_tol.set_value(fill_tol.get_value())
+        self.DAPPY.canvas.fill_tolerance=int(fill_tol.get_value())
 
         # Connecting signals properly...
         self.builder.connect_signals(self)
@@ -162,6 +190,7 @@ class GUI():
         else:
             q=True
         if q:
+            self.DAPPY.autosaver.stop()
             if event==gtk.gdk.DELETE:
                 return False
             else:
@@ -234,6 +263,25 @@ class GUI():
         self.DAPPY.canvas.airbrush_width= widget.get_value()
         self.curr_tool.grab_focus()
 
+    def change_airbrush_spacing(self, widget):
+        self.DAPPY.canvas.airbrush_spacing= widget.get_value()/100.0
+        self.curr_tool.grab_focus()
+
+    def change_airbrush_hardness(self, widget):
+        self.DAPPY.canvas.airbrush_hardness= widget.get_value()/100.0
+        self.curr_tool.grab_focus()
+
+    def change_airbrush_opacity(self, widget):
+        self.DAPPY.canvas.airbrush_opacity= widget.get_value()/100.0
+        self.curr_tool.grab_focus()
+
+    def change_fill_tolerance(self, widget):
+        self.DAPPY.canvas.fill_tolerance= int(widget.get_value())
+        self.curr_tool.grab_focus()
+
+    def change_fill_replace_all(self, widget):
+        self.DAPPY.canvas.fill_replace_all= widget.get_active()
+
     def set_sensitivity(self,widget,event):
         if event.action == "undo":
             self.builder.get_object("undo-button").set_sensitive(event.sensitive)
@@ -255,8 +303,14 @@ class GUI():
                 self.fig_cr.set_sensitive(False)
         elif tool=="airbrush":
             tbar = self.TB_AIRBRUSH
-        elif tool=="rect-select":
+        elif tool=="rect-select" or tool=="free-select" or tool=="magic-wand":
             tbar = self.TB_SELECTION
+            if tool=="magic-wand":
+                self.wand_tol.set_sensitive(True)
+            else:
+                self.wand_tol.set_sensitive(False)
+        elif tool=="bucket-fill":
+            tbar = self.TB_FILL
         else:
             tbar = self.TB_MISC
         for toolbar in self.cntxt_toolbars:
@@ -288,24 +342,74 @@ class GUI():
             self.secondary_a_slide.set_value(1.0)
             self.primary.set_rgba(0, 0, 0, 1)
             self.secondary.set_rgba(1, 1, 1, 1)
+            self.DAPPY.FileHandler.cancel_loads()
+            self.DAPPY.canvas.end_preview()
+            self.DAPPY.canvas.set_sensitive(True)
+            self.statusbar.pop(self.load_context)
             self.DAPPY.canvas.clear_overlay()
             self.DAPPY.canvas.delete()
             self.DAPPY.canvas.clear_undo_buffer()
+            self.DAPPY.autosaver.discard()
             self.DAPPY.filename = None
             self.DAPPY.canvas.modified=False
 
     def open(self, widget):
         info = self.DAPPY.FileHandler.open(self.DAPPY.path)
         self.DAPPY.set_current_info(info)
+        if info is not None:
+            self.statusbar.pop(self.load_context)
+            self.DAPPY.canvas.set_sensitive(not self.DAPPY.FileHandler.is_loading())
+
+    def load_progress(self, job, fraction):
+        self.statusbar.pop(self.load_context)
+        self.statusbar.push(self.load_context, "Loading %s: %d%%" % (os.path.basename(job.filename), int(fraction*100)))
+
+    def load_done(self, job):
+        self.statusbar.pop(self.load_context)
+        if job.error is not None:
+            error = gtk.MessageDialog(self.window, gtk.DIALOG_DESTROY_WITH_PARENT, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK, "Could not load %s: %s" % (job.filename, job.error))
+            error.run()
+            error.destroy()
+            #the preview is left to be worked on
+            self.DAPPY.canvas.end_preview(True)
+        else:
+            self.DAPPY.canvas.set_image(job.surface)
+            self.DAPPY.canvas.swap_buffers()
+        self.DAPPY.canvas.set_sensitive(True)
 
     def save(self, widget):
-        canonical_filename = self.DAPPY.FileHandler.save(self.DAPPY.canvas.get_image(), self.DAPPY.path, self.DAPPY.filename)
+        #saving the preview would overwrite the file with a blurred copy
+        if self.DAPPY.FileHandler.is_loading():
+            return
+        canvas = self.DAPPY.canvas
+        canonical_filename = self.DAPPY.FileHandler.save(canvas.snapshot(), self.DAPPY.path, self.DAPPY.filename, canvas.snapshot_history())
         self.DAPPY.fix_image_info(canonical_filename)
 
     def save_as(self, widget):
-        canonical_filename = self.DAPPY.FileHandler.save_as(self.DAPPY.canvas.get_image(), self.DAPPY.path, self.DAPPY.filename)
+        if self.DAPPY.FileHandler.is_loading():
+            return
+        canvas = self.DAPPY.canvas
+        canonical_filename = self.DAPPY.FileHandler.save_as(canvas.snapshot(), self.DAPPY.path, self.DAPPY.filename, canvas.snapshot_history())
         self.DAPPY.fix_image_info(canonical_filename)
 
+    def save_progress(self, job, fraction):
+        self.statusbar.pop(self.save_context)
+        self.statusbar.push(self.save_context, "Saving %s: %d%%" % (os.path.basename(job.filename), int(fraction*100)))
+
+    def save_done(self, job):
+        self.statusbar.pop(self.save_context)
+        if job.error is not None:
+            error = gtk.MessageDialog(self.window, gtk.DIALOG_DESTROY_WITH_PARENT, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK, "Could not save %s: %s" % (job.filename, job.error))
+            error.run()
+            error.destroy()
+        elif not job.cancelled:
+            self.statusbar.push(self.save_context, "Saved %s" % os.path.basename(job.filename))
+
+    def autosave_status(self, error):
+        self.statusbar.pop(self.autosave_context)
+        if error is not None:
+            self.statusbar.push(self.autosave_context, "Autosave failed: %s" % error)
+
     def cut(self, widget):
         self.DAPPY.canvas.copy(True)
 
@@ -19,21 +19,47 @@
 
 
 import gtk
+import gobject
 import os
 import gettext
-import imghdr
 import cairo
+import formats
+import numpy
+import struct
+import zlib
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from saving import SaveJob
+from loading import LoadJob, LoadCancelled, Preview
+from pixels import unpremultiply, premultiply, pixbuf_array, surface_array, new_surface
 
 _ = gettext.gettext
 
 class FileIO:
 
     def __init__(self):
-        png = PNGReaderWriter()
-
-        self.TOOLS_BY_FILTER = { png.get_filter() : png }
-        self.TOOLS_BY_IMGTYPE = { png.get_imgtype() : png }
+        # Codecs are only loaded when their format is first used
+        self.formats = formats.registry
         self.current_tool = None
+        # Saves still being written, and the GUI's callbacks for them
+        self.jobs = []
+        self.save_progress = None
+        self.save_done = None
+        # Full decodes of images opened from a preview
+        self.loads = []
+        self.load_progress = None
+        self.load_done = None
+
+    def set_save_callbacks(self, progress, done):
+        #progress(job, fraction) and done(job) are called in the main thread
+        self.save_progress = progress
+        self.save_done = done
+
+    def set_load_callbacks(self, progress, done):
+        #as for saves, done(job) is given the full image in job.surface
+        self.load_progress = progress
+        self.load_done = done
 
     def open(self, path):
         file_dialog = gtk.FileChooserDialog(title=None,
@@ -43,16 +69,17 @@ class FileIO:
               gtk.STOCK_OPEN, gtk.RESPONSE_OK)
            )
 
-        for tool in self.TOOLS_BY_FILTER.values():
-            file_dialog.add_filter(tool.get_filter())
+        file_dialog.add_filter(self.formats.get_all_filter())
+        for format in self.formats.readable():
+            file_dialog.add_filter(format.get_filter())
 
         file_dialog.set_title(_("Open Image"))
         file_dialog.set_current_folder(path)
 
         response = file_dialog.run()
         if response == gtk.RESPONSE_OK:
-            self.current_tool = self.TOOLS_BY_FILTER[file_dialog.get_filter()]
-            result = self.current_tool.read(file_dialog.get_filename())
+            #the format is found from the file, whichever filter is chosen
+            result = self.read(file_dialog.get_filename())
         else:
             result = None
         file_dialog.destroy()
@@ -60,17 +87,19 @@ class FileIO:
         return result
 
 
-    def save(self, image, path, filename=None):
+    def save(self, image, path, filename=None, history=None):
+        # image is a TiledImage snapshot, history a snapshot of the undo
+        # history for formats that keep it
         if filename == None:
-            canonical_filename = self.save_as(image, path)
+            canonical_filename = self.save_as(image, path, history=history)
         else:
             canonical_filename = path + os.sep + filename
             self.__detect_tool(canonical_filename)
-            self.current_tool.write(image, canonical_filename)
+            self.__start_save(image, canonical_filename, history)
         return canonical_filename
 
 
-    def save_as(self, image, path, filename=None):
+    def save_as(self, image, path, filename=None, history=None):
         file_dialog = gtk.FileChooserDialog(title=None,
            action=gtk.FILE_CHOOSER_ACTION_SAVE,
            buttons=(gtk.STOCK_CANCEL,
@@ -86,61 +115,266 @@ class FileIO:
         else:
             file_dialog.set_current_folder(path)
 
-        for tool in self.TOOLS_BY_FILTER.values():
-            file_dialog.add_filter(tool.get_filter())
+        for format in self.formats.writable():
+            file_dialog.add_filter(format.get_filter())
 
         response = file_dialog.run()
         if response == gtk.RESPONSE_OK:
-            self.current_tool = self.TOOLS_BY_FILTER[file_dialog.get_filter()]
             filename = file_dialog.get_filename()
-            if not os.path.exists(filename):
-                pat_good = False
-                for pat in self.current_tool.patterns:
-                    if filename.endswith(pat):
-                        pat_good=True
-                if not pat_good:
-                    filename += self.current_tool.patterns[0]
-            self.current_tool.write(image, filename)
+            #a name typed with the extension of another format saves as that
+            format = self.formats.by_name(filename)
+            if format is None or not format.can_write():
+                format = self.formats.by_filter(file_dialog.get_filter())
+            if format is None and os.path.exists(filename):
+                #a file being overwritten keeps its own format
+                try:
+                    format = self.formats.sniff(filename)
+                except IOError:
+                    pass
+            if format is None or not format.can_write():
+                error = gtk.MessageDialog(file_dialog, gtk.DIALOG_DESTROY_WITH_PARENT, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK,
+                                          _("Could not tell which format to save %s in, choose a file type or add its extension") % os.path.basename(filename))
+                error.run()
+                error.destroy()
+                filename = None
+            else:
+                self.current_tool = format.get_codec()
+                if not os.path.exists(filename):
+                    if not format.matches_name(filename):
+                        filename += format.patterns[0]
+                self.__start_save(image, filename, history)
         else:
             filename = None
         file_dialog.destroy()
         return filename
 
 
+    def __start_save(self, image, filename, history=None):
+        # The snapshot is written in the background.
+        # An older save of the same file would only be overwritten by this one.
+        for job in self.jobs:
+            if job.filename == filename:
+                job.cancel()
+        job = SaveJob(image, filename, self.current_tool, gobject.idle_add, self.save_progress, self.__saved, history)
+        self.jobs.append(job)
+        job.start()
+
+    def __saved(self, job):
+        self.jobs.remove(job)
+        if self.save_done is not None:
+            self.save_done(job)
+
+    def is_saving(self):
+        return len(self.jobs) > 0
+
+
     def read(self, filename):
+        # Big images may be opened at once from a Preview, the full image
+        # follows in the background and is handed to load_done
+        self.cancel_loads()
         self.__detect_tool(filename)
-        return self.current_tool.read(filename)
+        preview = self.current_tool.read_preview(filename)
+        if preview is None:
+            return self.current_tool.read(filename)
+        job = LoadJob(filename, self.current_tool, gobject.idle_add, self.__load_progress, self.__loaded)
+        self.loads.append(job)
+        job.start()
+        return (filename, preview)
+
+    def __load_progress(self, job, fraction):
+        #the GUI may connect after a file given on the command line is opened
+        if self.load_progress is not None and not job.cancelled:
+            self.load_progress(job, fraction)
+
+    def __loaded(self, job):
+        self.loads.remove(job)
+        if self.load_done is not None and not job.cancelled:
+            self.load_done(job)
+
+    def is_loading(self):
+        return len(self.loads) > 0
+
+    def cancel_loads(self):
+        for job in self.loads:
+            job.cancel()
 
 
     def __detect_tool(self, filename):
-        imgtype = imghdr.what(filename)
-        self.current_tool = self.TOOLS_BY_IMGTYPE[imgtype]
+        #files are known by their first bytes, new ones by their name
+        if os.path.exists(filename):
+            format = self.formats.sniff(filename)
+        else:
+            format = self.formats.by_name(filename)
+        if format is None:
+            raise IOError("Unknown image format: %s" % filename)
+        self.current_tool = format.get_codec()
 
 class ReaderWriter:
-    FILTER = None
-    IMGTYPE = None
-    patterns = None
+    # Reads and writes one format, made by its entry in the formats registry
+    # the first time the format is used.
+    # Writers that can encode straight from a TiledImage have write_tiles,
+    # the others are given the whole image as a surface
+    TILED = False
 
-    def get_filter(self):
-        return self.FILTER
+    def can_read(self):
+        return True
 
-    def get_imgtype(self):
-        return self.IMGTYPE
+    def can_write(self):
+        return True
 
-    def read(self, canonical_filename): pass
-    def write(self, image, canonical_filename): pass
+    #writers that can save by adding to a file they wrote before, rather
+    #than writing it all again, say so for that file and do it in append
+    def can_append(self, canonical_filename):
+        return False
 
+    def append(self, image, canonical_filename, job=None): pass
 
+    def read(self, canonical_filename): pass
+    def write(self, image, canonical_filename): pass
+    #write to an open file, job (a SaveJob if not None) is told of progress
+    def write_file(self, image, f, job=None): pass
+    def write_tiles(self, image, f, job=None): pass
+    #a quick stand in for the image while read_file decodes it in the
+    #background, or None if it is read straight away
+    def read_preview(self, canonical_filename): return None
+    def read_file(self, f, job=None): pass
+
+
+
+# Images with more pixels than this are opened from a draft when their format
+# can decode one quickly, the full image follows in the background
+DRAFT_PIXELS = 4000000
+# Longest side of a draft
+DRAFT_SIZE = 1024
+# Bytes given to a pixbuf loader at a time when decoding in the background
+LOAD_CHUNK = 256*1024
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+# PNG row filters, each row is stored as its difference from a prediction
+# made from the pixels left of and above it. ADAPTIVE tries them all on each
+# row and keeps the one leaving the smallest differences.
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_AVERAGE = 3
+FILTER_PAETH = 4
+FILTER_ADAPTIVE = 5
+
+# Compression presets of (zlib level, filter), from quickest to smallest
+PNG_PRESETS = {
+    "fast": (1, FILTER_UP),
+    "default": (6, FILTER_ADAPTIVE),
+    "small": (9, FILTER_ADAPTIVE),
+}
+
+def png_chunk(kind, data):
+    crc = zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff
+    return struct.pack(">I", len(data))+kind+data+struct.pack(">I", crc)
+
+def filter_rows(rgba, prev, method=FILTER_ADAPTIVE):
+    # Filter a height x width x 4 array of RGBA rows, prev is the row above
+    # the first. Returns the rows as PNG stores them, each led by the type of
+    # filter used on it.
+    h, w = rgba.shape[:2]
+    raw = rgba.reshape(h, w*4)
+    up = numpy.empty_like(raw)
+    up[0] = prev.reshape(w*4)
+    up[1:] = raw[:-1]
+    left = numpy.zeros_like(raw)
+    left[:, 4:] = raw[:, :-4]
+    if method == FILTER_ADAPTIVE:
+        methods = range(FILTER_ADAPTIVE)
+    else:
+        methods = [method]
+    filtered = []
+    for m in methods:
+        if m == FILTER_NONE:
+            filtered.append(raw)
+        elif m == FILTER_SUB:
+            filtered.append(raw-left)
+        elif m == FILTER_UP:
+            filtered.append(raw-up)
+        elif m == FILTER_AVERAGE:
+            filtered.append(raw-((left.astype(numpy.uint16)+up)>>1).astype(numpy.uint8))
+        else:
+            filtered.append(raw-paeth_predict(left, up))
+    rows = numpy.empty((h, w*4+1), numpy.uint8)
+    if len(methods) == 1:
+        rows[:, 0] = methods[0]
+        rows[:, 1:] = filtered[0]
+        return rows
+    #rows are scored by how far their bytes are from zero as signed
+    #differences, abs(-128) wraps back to 128 as unsigned
+    costs = [numpy.abs(f.view(numpy.int8)).view(numpy.uint8).sum(axis=1, dtype=numpy.uint32) for f in filtered]
+    best = numpy.argmin(costs, axis=0)
+    rows[:, 0] = best
+    for m in methods:
+        chosen = best == m
+        rows[chosen, 1:] = filtered[m][chosen]
+    return rows
+
+def paeth_predict(left, up):
+    # Whichever of left, up and up-left is nearest to left+up-upleft, the
+    # distances to each simplify to |up-upleft|, |left-upleft| and
+    # |left+up-2*upleft|
+    upleft = numpy.zeros_like(up)
+    upleft[:, 4:] = up[:, :-4]
+    a = left.astype(numpy.int16)
+    b = up.astype(numpy.int16)
+    c = upleft.astype(numpy.int16)
+    pa = numpy.abs(b-c)
+    pb = numpy.abs(a-c)
+    pc = numpy.abs(a+b-2*c)
+    return numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, up, upleft))
+
+def zlib_header(level):
+    #the two bytes before a deflate stream, the check bits make it divisible by 31
+    flevel = 0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3
+    flg = flevel << 6
+    flg += 31-((0x78 << 8)+flg) % 31
+    return struct.pack("BB", 0x78, flg)
+
+def adler32_combine(adler1, adler2, length2):
+    # The adler32 of two pieces of data one after the other, from the adler32
+    # of each and the length of the second, as zlib's adler32_combine.
+    base = 65521
+    rem = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem*sum1) % base
+    sum1 += (adler2 & 0xffff)+base-1
+    sum2 += (adler1 >> 16)+(adler2 >> 16)+base-rem
+    return (sum1 % base) | ((sum2 % base) << 16)
+
+def tile_strip(image, row):
+    #height x width x BGRA array of a row of tiles of a TiledImage
+    ts = image.tile_size
+    x, y, w, h = image.tile_rect((0, row))
+    strip = numpy.empty((h, image.width, 4), numpy.uint8)
+    for key in image.keys_in_rect((0, y, image.width, 1)):
+        tx, ty, tw, th = image.tile_rect(key)
+        tile = numpy.frombuffer(image.get_tile(key), numpy.uint8).reshape(ts, ts, 4)
+        strip[:, tx:tx+tw] = tile[:th, :tw]
+    return strip
 
 class PNGReaderWriter(ReaderWriter):
-    def __init__(self):
-        self.FILTER = gtk.FileFilter()
-        self.FILTER.set_name("PNG - Portable Network Graphics")
-        self.FILTER.add_mime_type("image/png")
-        self.IMGTYPE = "png"
-        self.patterns = ('.png','.PNG',)
-        for pat in self.patterns:
-            self.FILTER.add_pattern("*"+pat)
+    # Writes PNGs straight from the tiles a row of tiles at a time, so only
+    # that much of the image is ever unpacked. With more than one thread the
+    # rows of tiles are filtered and deflated separately in parallel, each
+    # ending on a byte boundary so the pieces join into one zlib stream.
+    TILED = True
+    level = None
+    filter = None
+    threads = None
+
+    def __init__(self, preset="default", threads=None):
+        self.level, self.filter = PNG_PRESETS[preset]
+        if threads is None:
+            try:
+                threads = multiprocessing.cpu_count()
+            except NotImplementedError:
+                threads = 1
+        self.threads = threads
 
 
     def read(self, canonical_filename):
@@ -152,22 +386,189 @@ class PNGReaderWriter(ReaderWriter):
         image.write_to_png(canonical_filename)
 
 
+    def write_file(self, image, f, job=None):
+        image.write_to_png(f)
 
-class JPEGReaderWriter(ReaderWriter):
-    def __init__(self):
-        self.FILTER = gtk.FileFilter()
-        self.FILTER.set_name("JPG - Portable Network Graphics")
-        self.FILTER.add_mime_type("image/jpeg")
-        self.IMGTYPE = "jpeg"
-        self.patterns = (".jpg",'.jpeg')
-        for pat in self.patterns:
-            self.FILTER.add_pattern("*"+pat)
+
+    def write_tiles(self, image, f, job=None):
+        f.write(PNG_SIGNATURE)
+        #8 bit RGBA, straight alpha
+        f.write(png_chunk("IHDR", struct.pack(">IIBBBBB", image.width, image.height, 8, 6, 0, 0, 0)))
+        if self.threads > 1:
+            self.__write_parallel(image, f, job)
+        else:
+            self.__write_stream(image, f, job)
+        f.write(png_chunk("IEND", ""))
+
+
+    def __strips(self, image):
+        #each row of tiles with the premultiplied row above it
+        prev = numpy.zeros((1, image.width, 4), numpy.uint8)
+        for row in range(image.get_n_tiles()[1]):
+            strip = tile_strip(image, row)
+            yield strip, prev
+            prev = strip[-1:]
+
+
+    def __filter(self, strip, prev):
+        return filter_rows(unpremultiply(strip), unpremultiply(prev), self.filter).tostring()
+
+
+    def __write_stream(self, image, f, job):
+        compressor = zlib.compressobj(self.level)
+        done = 0
+        for strip, prev in self.__strips(image):
+            data = compressor.compress(self.__filter(strip, prev))
+            if data:
+                f.write(png_chunk("IDAT", data))
+            done += len(strip)
+            if job is not None:
+                job.set_encode_progress(float(done)/image.height)
+        f.write(png_chunk("IDAT", compressor.flush()))
+
+
+    def __deflate(self, strip, prev, last):
+        #one piece of the stream, raw deflate with no header
+        data = self.__filter(strip, prev)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data)
+        if last:
+            deflated += compressor.flush(zlib.Z_FINISH)
+        else:
+            deflated += compressor.flush(zlib.Z_SYNC_FLUSH)
+        return deflated, zlib.adler32(data) & 0xffffffff, len(data), len(strip)
+
+
+    def __write_parallel(self, image, f, job):
+        # Rows of tiles are handed to the pool in order and written out in
+        # order, with only a few more in hand than there are threads.
+        pool = ThreadPool(self.threads)
+        try:
+            f.write(png_chunk("IDAT", zlib_header(self.level)))
+            rows = image.get_n_tiles()[1]
+            pending = deque()
+            adler = 1
+            done = 0
+            for row, (strip, prev) in enumerate(self.__strips(image)):
+                last = row == rows-1
+                pending.append(pool.apply_async(self.__deflate, (strip, prev, last)))
+                while len(pending) > 2*self.threads or (last and pending):
+                    deflated, piece_adler, length, height = pending.popleft().get()
+                    f.write(png_chunk("IDAT", deflated))
+                    adler = adler32_combine(adler, piece_adler, length)
+                    done += height
+                    if job is not None:
+                        job.set_encode_progress(float(done)/image.height)
+            f.write(png_chunk("IDAT", struct.pack(">I", adler)))
+        finally:
+            pool.close()
+            pool.join()
+
+
+
+# {name: writable} of gdk-pixbuf's formats, filled in when first needed as
+# finding them means scanning its loaders
+pixbuf_formats = {}
+
+def get_pixbuf_formats():
+    if not pixbuf_formats:
+        for info in gtk.gdk.pixbuf_get_formats():
+            pixbuf_formats[info["name"]] = info["is_writable"]
+    return pixbuf_formats
+
+def pixbuf_surface(pixbuf):
+    #ARGB32 surface holding a copy of a pixbuf's pixels
+    return new_surface(premultiply(pixbuf_array(pixbuf)))
+
+def surface_pixbuf(surface, alpha=True):
+    #pixbuf holding a copy of a surface's pixels, alpha is dropped if False
+    rgba = unpremultiply(surface_array(surface))
+    if not alpha:
+        rgba = numpy.ascontiguousarray(rgba[..., :3])
+    h, w, n = rgba.shape
+    return gtk.gdk.pixbuf_new_from_data(rgba.tostring(), gtk.gdk.COLORSPACE_RGB, alpha, 8, w, h, w*n)
+
+class PixbufReaderWriter(ReaderWriter):
+    # Formats read and written by gdk-pixbuf, PIXBUF_TYPE is its name for
+    # the format and options are passed to its saver. Formats gdk-pixbuf
+    # was built without can't be read or written.
+    PIXBUF_TYPE = None
+    alpha = None
+    options = None
+
+    def __init__(self, pixbuf_type, alpha=True, options=None):
+        self.PIXBUF_TYPE = pixbuf_type
+        self.alpha = alpha
+        if options is None:
+            options = {}
+        self.options = options
+
+
+    def can_read(self):
+        return self.PIXBUF_TYPE in get_pixbuf_formats()
+
+
+    def can_write(self):
+        return get_pixbuf_formats().get(self.PIXBUF_TYPE, False)
 
 
     def read(self, canonical_filename):
         return (canonical_filename,
-           cairo.ImageSurface.create_from_png(canonical_filename))
+           pixbuf_surface(gtk.gdk.pixbuf_new_from_file(canonical_filename)))
+
+
+    def read_file(self, f, job=None):
+        # Feed the file to a pixbuf loader a piece at a time, so a LoadJob
+        # can show progress and be cancelled between pieces
+        size = max(os.fstat(f.fileno()).st_size, 1)
+        loader = gtk.gdk.PixbufLoader(self.PIXBUF_TYPE)
+        done = 0
+        try:
+            data = f.read(LOAD_CHUNK)
+            while data:
+                loader.write(data)
+                done += len(data)
+                if job is not None:
+                    job.set_progress(float(done)/size)
+                data = f.read(LOAD_CHUNK)
+        except LoadCancelled:
+            #closing a loader part way through complains the image is cut short
+            try:
+                loader.close()
+            except gobject.GError:
+                pass
+            raise
+        loader.close()
+        return pixbuf_surface(loader.get_pixbuf())
 
 
     def write(self, image, canonical_filename):
-        image.write_to_png(canonical_filename)
+        surface_pixbuf(image, self.alpha).save(canonical_filename, self.PIXBUF_TYPE, self.options)
+
+
+    def write_file(self, image, f, job=None):
+        try:
+            surface_pixbuf(image, self.alpha).save_to_callback(f.write, self.PIXBUF_TYPE, self.options)
+        except gobject.GError, e:
+            #as cairo does, so the save is reported as cancelled or failed
+            raise IOError(str(e))
+
+
+
+class JPEGReaderWriter(PixbufReaderWriter):
+    def __init__(self):
+        PixbufReaderWriter.__init__(self, "jpeg", alpha=False, options={"quality": "90"})
+
+
+    def read_preview(self, canonical_filename):
+        # Big photos open at once from a draft: libjpeg decodes straight to
+        # a fraction of the size, far quicker than the whole image. It is
+        # kept at that size, the canvas scales it while the rest is decoded.
+        info = gtk.gdk.pixbuf_get_file_info(canonical_filename)
+        if info is None:
+            return None
+        w, h = info[1], info[2]
+        if w*h <= DRAFT_PIXELS:
+            return None
+        draft = pixbuf_surface(gtk.gdk.pixbuf_new_from_file_at_size(canonical_filename, DRAFT_SIZE, DRAFT_SIZE))
+        return Preview(draft, w, h)
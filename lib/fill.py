@@ -0,0 +1,152 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import numpy
+import region
+from pixels import surface_array, surface_words, pack
+
+def match_mask(surface, area, colour, tolerance=0):
+    # True where every channel of a pixel of the surface (or of the part in
+    # area) is within tolerance of colour
+    if tolerance == 0:
+        #compare whole pixels at once
+        return surface_words(surface, area) == pack(colour)
+    pixels = surface_array(surface, area)
+    mask = numpy.ones(pixels.shape[:2], numpy.bool_)
+    for c in range(4):
+        mask &= numpy.abs(pixels[:, :, c].astype(numpy.int16)-int(colour[c])) <= tolerance
+    return mask
+
+def mask_bounds(mask):
+    rows = numpy.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return region.EMPTY
+    cols = numpy.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]-cols[0]+1), int(rows[-1]-rows[0]+1))
+
+def mask_runs(mask):
+    # The runs of True in each row of a boolean array as arrays of rows,
+    # starts and ends (exclusive), in row order. A run starts where a row goes
+    # from False to True and ends where it goes back, padding both sides
+    # catches runs touching the edges.
+    h, w = mask.shape
+    padded = numpy.zeros((h, w+2), numpy.int8)
+    padded[:, 1:-1] = mask
+    steps = numpy.diff(padded, axis=1)
+    rows, starts = numpy.nonzero(steps == 1)
+    ends = numpy.nonzero(steps == -1)[1]
+    return rows, starts, ends
+
+def runs_mask(runs, bounds):
+    # Boolean array covering bounds of (row, start, end) runs. Each run adds
+    # one at its start and takes one off at its end, so a running sum along
+    # the rows is non-zero inside runs.
+    bx, by, bw, bh = bounds
+    edges = numpy.zeros((bh, bw+1), numpy.int32)
+    numpy.add.at(edges, (runs[:, 0]-by, runs[:, 1]-bx), 1)
+    numpy.add.at(edges, (runs[:, 0]-by, runs[:, 2]-bx), -1)
+    return numpy.cumsum(edges, axis=1)[:, :bw] > 0
+
+def grow_runs(mask, x, y):
+    # The 4-connected part of mask containing (x,y), as (row, start, end) runs
+    # and their bounds. All the runs of the mask are found at once, runs in
+    # neighbouring rows that overlap are joined, and the runs joined to the
+    # one under (x,y) are kept. Each step works on whole arrays of runs, so
+    # a noisy or winding region costs no more than its number of runs.
+    h, w = mask.shape
+    rows, starts, ends = mask_runs(mask)
+    #runs keyed by their place counting along the rows one after another,
+    #the keys are in order so runs can be looked up with searchsorted
+    stride = w+1
+    base = rows.astype(numpy.int64)*stride
+    start_keys = base+starts
+    end_keys = base+ends
+    seed = numpy.searchsorted(start_keys, y*stride+x, "right")-1
+    if seed < 0 or rows[seed] != y or ends[seed] <= x:
+        return numpy.zeros((0, 3), numpy.int32), region.EMPTY
+    #the runs of the next row overlapping a run are those from the first
+    #ending after it starts up to the last starting before it ends
+    lo = numpy.searchsorted(end_keys, base+stride+starts, "right")
+    hi = numpy.searchsorted(start_keys, base+stride+ends, "left")
+    counts = numpy.maximum(hi-lo, 0)
+    first = numpy.repeat(numpy.arange(rows.size), counts)
+    second = numpy.repeat(lo-numpy.cumsum(counts)+counts, counts)+numpy.arange(counts.sum())
+    #union-find over every pair at once: hook each root onto the smallest
+    #root it is paired with, then point every run straight at its root
+    labels = numpy.arange(rows.size)
+    while first.size:
+        a = labels[first]
+        b = labels[second]
+        apart = a != b
+        if not apart.any():
+            break
+        first = first[apart]
+        second = second[apart]
+        a = a[apart]
+        b = b[apart]
+        numpy.minimum.at(labels, numpy.maximum(a, b), numpy.minimum(a, b))
+        while True:
+            up = labels[labels]
+            if (up == labels).all():
+                break
+            labels = up
+    keep = labels == labels[seed]
+    runs = numpy.column_stack((rows[keep], starts[keep], ends[keep])).astype(numpy.int32)
+    bx = int(runs[:, 1].min())
+    bounds = (bx, int(runs[0, 0]), int(runs[:, 2].max())-bx, int(runs[-1, 0]-runs[0, 0])+1)
+    return runs, bounds
+
+def fill(surface, x, y, colour, tolerance=0, replace_all=False, selection=None, hold=None):
+    # Fill the area around (x,y) that is within tolerance of the colour there,
+    # or with replace_all every matching pixel in the image, with colour (a
+    # premultiplied BGRA tuple). With a selection only the pixels in it are
+    # looked at. hold(rect) is called with the area to be filled before any
+    # of it is written. Returns the bounds of what was filled.
+    x = int(x)
+    y = int(y)
+    area = (0, 0, surface.get_width(), surface.get_height())
+    if selection is not None:
+        selection = selection.clip(area)
+        if not selection.contains(x, y):
+            return region.EMPTY
+        area = selection.get_bounds()
+    elif region.is_empty(region.intersect(area, (x, y, 1, 1))):
+        return region.EMPTY
+    ox, oy = area[:2]
+    seed = tuple(surface_array(surface, (x, y, 1, 1))[0, 0])
+    if tolerance == 0 and seed == tuple(colour):
+        return region.EMPTY
+    mask = match_mask(surface, area, seed, tolerance)
+    if selection is not None:
+        mask &= selection.to_mask()
+    if replace_all:
+        bounds = mask_bounds(mask)
+        bx, by, bw, bh = bounds
+        mask = mask[by:by+bh, bx:bx+bw]
+    else:
+        runs, bounds = grow_runs(mask, x-ox, y-oy)
+        bx, by, bw, bh = bounds
+        mask = runs_mask(runs, bounds)
+    if hold is not None:
+        hold((bx+ox, by+oy, bw, bh))
+    #a single masked assignment of whole pixels over the bounds
+    words = surface_words(surface, (bx+ox, by+oy, bw, bh))
+    numpy.copyto(words, pack(colour), where=mask)
+    surface.mark_dirty()
+    return (bx+ox, by+oy, bw, bh)
@@ -0,0 +1,171 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# The image formats Dappy knows about. Registering a format costs nothing:
+# the reader/writer (codec) for it is named by "module.Class" and is only
+# imported and made the first time a file of that format is opened or saved,
+# or a file dialog lists it. Other code can add formats with register().
+
+import gtk
+import gettext
+
+_ = gettext.gettext
+
+# Bytes read from the start of a file to tell its format
+SNIFF_SIZE = 64
+
+class Format:
+    # magic is a list of signatures, any one of which marks a file as this
+    # format. A signature is a list of (offset, bytes) that must all match.
+    name = None
+    mime_type = None
+    patterns = None
+    magic = None
+    codec_name = None
+    codec_args = None
+    codec_kwargs = None
+    codec = None
+    filter = None
+
+    def __init__(self, name, mime_type, patterns, magic, codec, args=(), kwargs=None):
+        # codec is "module.Class" or anything callable with args and kwargs
+        # that returns a ReaderWriter
+        self.name = name
+        self.mime_type = mime_type
+        self.patterns = patterns
+        self.magic = magic
+        self.codec_name = codec
+        self.codec_args = args
+        if kwargs is None:
+            kwargs = {}
+        self.codec_kwargs = kwargs
+
+    def matches(self, head):
+        #whether the first bytes of a file are one of this format's signatures
+        for signature in self.magic:
+            for offset, data in signature:
+                if head[offset:offset+len(data)] != data:
+                    break
+            else:
+                return True
+        return False
+
+    def matches_name(self, filename):
+        for pat in self.patterns:
+            if filename.endswith(pat):
+                return True
+        return False
+
+    def get_codec(self):
+        if self.codec is None:
+            factory = self.codec_name
+            if isinstance(factory, basestring):
+                module, name = factory.rsplit(".", 1)
+                factory = getattr(__import__(module), name)
+            self.codec = factory(*self.codec_args, **self.codec_kwargs)
+        return self.codec
+
+    def can_read(self):
+        return self.get_codec().can_read()
+
+    def can_write(self):
+        return self.get_codec().can_write()
+
+    def get_filter(self):
+        if self.filter is None:
+            self.filter = gtk.FileFilter()
+            self.filter.set_name(self.name)
+            self.filter.add_mime_type(self.mime_type)
+            for pat in self.patterns:
+                self.filter.add_pattern("*"+pat)
+        return self.filter
+
+class Registry:
+    formats = None
+    all_filter = None
+
+    def __init__(self):
+        self.formats = []
+
+    def register(self, format):
+        #later registrations are tried first, so they can take over a format
+        self.formats.insert(0, format)
+        self.all_filter = None
+
+    def get_formats(self):
+        return list(self.formats)
+
+    def readable(self):
+        return [f for f in reversed(self.formats) if f.can_read()]
+
+    def writable(self):
+        return [f for f in reversed(self.formats) if f.can_write()]
+
+    def sniff(self, filename):
+        # The format a file is in going by its first bytes, or by its name if
+        # none of the signatures match. None if neither is known.
+        f = open(filename, "rb")
+        try:
+            head = f.read(SNIFF_SIZE)
+        finally:
+            f.close()
+        for format in self.formats:
+            if format.matches(head):
+                return format
+        return self.by_name(filename)
+
+    def by_name(self, filename):
+        for format in self.formats:
+            if format.matches_name(filename):
+                return format
+        return None
+
+    def by_filter(self, filter):
+        for format in self.formats:
+            if format.filter is filter:
+                return format
+        return None
+
+    def get_all_filter(self):
+        #a filter taking every readable format, for opening files
+        if self.all_filter is None:
+            self.all_filter = gtk.FileFilter()
+            self.all_filter.set_name(_("All Images"))
+            for format in self.readable():
+                for pat in format.patterns:
+                    self.all_filter.add_pattern("*"+pat)
+        return self.all_filter
+
+registry = Registry()
+
+def register(format):
+    registry.register(format)
+
+register(Format("PNG - Portable Network Graphics", "image/png", (".png", ".PNG"),
+                [[(0, "\x89PNG\r\n\x1a\n")]], "file_io.PNGReaderWriter"))
+register(Format("JPG - Joint Photographic Experts Group", "image/jpeg", (".jpg", ".jpeg", ".JPG", ".JPEG"),
+                [[(0, "\xff\xd8\xff")]], "file_io.JPEGReaderWriter"))
+register(Format("BMP - Windows Bitmap", "image/bmp", (".bmp", ".BMP"),
+                [[(0, "BM")]], "file_io.PixbufReaderWriter", ("bmp",)))
+register(Format("TIFF - Tagged Image File Format", "image/tiff", (".tif", ".tiff", ".TIF", ".TIFF"),
+                [[(0, "II*\0")], [(0, "MM\0*")]], "file_io.PixbufReaderWriter", ("tiff",)))
+register(Format("WebP", "image/webp", (".webp", ".WEBP"),
+                [[(0, "RIFF"), (8, "WEBP")]], "file_io.PixbufReaderWriter", ("webp",), {"options": {"quality": "90"}}))
+register(Format("Dappy Project", "application/x-dappy", (".dappy", ".DAPPY"),
+                [[(0, "DAPPYPRJ")]], "project.ProjectReaderWriter"))
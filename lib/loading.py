@@ -0,0 +1,87 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import threading
+import gobject
+
+class LoadCancelled(Exception):
+    pass
+
+class Preview:
+    # A reduced size draft of an image still being decoded, shown scaled up
+    # to the image's full size until the image itself arrives
+    surface = None
+    width = None
+    height = None
+
+    def __init__(self, surface, width, height):
+        self.surface = surface
+        self.width = width
+        self.height = height
+
+class LoadJob(threading.Thread):
+    # Decodes a file on a worker thread with reader.read_file, for images
+    # opened from a quick preview. When done(job) is run with call_in_main
+    # the image is in surface, or what went wrong in error.
+    # progress(job, fraction) is also run with call_in_main.
+    filename = None
+    reader = None
+    call_in_main = None
+    progress = None
+    done = None
+    cancelled = None
+    surface = None
+    error = None
+
+    def __init__(self, filename, reader, call_in_main, progress=None, done=None):
+        threading.Thread.__init__(self)
+        #nothing is lost by dropping a load at exit
+        self.daemon = True
+        self.filename = filename
+        self.reader = reader
+        self.call_in_main = call_in_main
+        self.progress = progress
+        self.done = done
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def set_progress(self, fraction):
+        #called by the worker, raises LoadCancelled once cancelled
+        if self.cancelled:
+            raise LoadCancelled()
+        if self.progress is not None:
+            self.call_in_main(self.progress, self, fraction)
+
+    def run(self):
+        try:
+            try:
+                f = open(self.filename, "rb")
+                try:
+                    self.surface = self.reader.read_file(f, self)
+                finally:
+                    f.close()
+            except LoadCancelled:
+                self.cancelled = True
+            except (IOError, OSError, gobject.GError), e:
+                self.error = e
+        finally:
+            if self.done is not None:
+                self.call_in_main(self.done, self)
@@ -0,0 +1,94 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import cairo
+import math
+import region
+
+class MipPyramid:
+    # Copies of an image each half the size of the one before, so drawing it
+    # zoomed out only ever shrinks a level by up to half rather than sampling
+    # every pixel of the full image. Levels are made the first time they are
+    # needed, afterwards only the parts under areas of the image that have
+    # changed are remade, when the level is next used.
+    source = None
+    levels = None
+    stale = None
+
+    def __init__(self):
+        self.levels = []
+        self.stale = []
+
+    def invalidate(self, rect=None):
+        #rect (None for all) of the source image has changed
+        for n in range(1, len(self.levels)):
+            self.stale[n] = region.union(self.stale[n], rect)
+
+    def get_level(self, surface, zoom):
+        # The level to draw surface with at zoom and the scale to draw it at
+        # to get back to the size of the source.
+        if surface is not self.source:
+            self.source = surface
+            self.levels = [surface]
+            self.stale = [region.EMPTY]
+        n = 0
+        while zoom*2**(n+1) <= 1 and min(self.__level_size(n)) > 1:
+            n += 1
+        for m in range(1, n+1):
+            if m >= len(self.levels):
+                self.levels.append(cairo.ImageSurface(cairo.FORMAT_ARGB32, *self.__level_size(m)))
+                self.stale.append(None)
+            if not region.is_empty(self.stale[m]):
+                self.__update(m, self.stale[m])
+                self.stale[m] = region.EMPTY
+        return self.levels[n], 2**n
+
+    def __level_size(self, n):
+        #odd sizes round up so the last row and column aren't lost
+        w = self.source.get_width()
+        h = self.source.get_height()
+        for m in range(n):
+            w = (w+1)//2
+            h = (h+1)//2
+        return (w, h)
+
+    def __update(self, n, rect):
+        #remake the part of level n under rect of the source image
+        level = self.levels[n]
+        size = (0, 0, level.get_width(), level.get_height())
+        if rect is not None:
+            f = 2**n
+            x0 = rect[0]//f
+            y0 = rect[1]//f
+            x1 = int(math.ceil((rect[0]+rect[2])/float(f)))
+            y1 = int(math.ceil((rect[1]+rect[3])/float(f)))
+            size = region.intersect(size, (x0, y0, x1-x0, y1-y0))
+        if region.is_empty(size):
+            return
+        context = cairo.Context(level)
+        context.rectangle(*size)
+        context.clip()
+        #each pixel is the average of the 2x2 block above it
+        context.scale(0.5, 0.5)
+        context.set_source_surface(self.levels[n-1], 0, 0)
+        pattern = context.get_source()
+        pattern.set_filter(cairo.FILTER_BILINEAR)
+        pattern.set_extend(cairo.EXTEND_PAD)
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.paint()
@@ -0,0 +1,113 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# NumPy access to cairo FORMAT_ARGB32 surfaces. Cairo keeps each pixel as a
+# native endian 32 bit premultiplied ARGB value, which on little endian
+# machines is B, G, R, A in memory, so the views here are BGRA. Anything that
+# writes through a view must call surface.mark_dirty() afterwards.
+
+import cairo
+import numpy
+
+def surface_array(surface, rect=None):
+    # height x width x BGRA view of the surface memory (or of the part in
+    # rect), nothing is copied
+    surface.flush()
+    array = numpy.ndarray((surface.get_height(), surface.get_width(), 4), numpy.uint8,
+                          surface.get_data(), 0, (surface.get_stride(), 4, 1))
+    if rect is not None:
+        x, y, w, h = rect
+        array = array[y:y+h, x:x+w]
+    return array
+
+def new_surface(bgra):
+    #ARGB32 surface holding a copy of a height x width x BGRA array
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, bgra.shape[1], bgra.shape[0])
+    surface_array(surface)[...] = bgra
+    surface.mark_dirty()
+    return surface
+
+def pixbuf_array(pixbuf):
+    # height x width x RGB(A) array of a gdk pixbuf's pixels, the last row
+    # of a pixbuf need not be padded out to the rowstride
+    w = pixbuf.get_width()
+    n = pixbuf.get_n_channels()
+    return numpy.ndarray((pixbuf.get_height(), w, n), numpy.uint8,
+                         pixbuf.get_pixels(), 0, (pixbuf.get_rowstride(), n, 1))
+
+def alpha_array(surface):
+    #height x width view of a FORMAT_A8 surface
+    surface.flush()
+    return numpy.ndarray((surface.get_height(), surface.get_width()), numpy.uint8,
+                         surface.get_data(), 0, (surface.get_stride(), 1))
+
+def surface_words(surface, rect=None):
+    # height x width view of whole 32 bit pixels (or of the part in rect).
+    # Made from the surface memory itself, NumPy before 1.23 can't view a
+    # sub-rectangle of surface_array as a bigger type.
+    surface.flush()
+    words = numpy.ndarray((surface.get_height(), surface.get_width()), numpy.uint32,
+                          surface.get_data(), 0, (surface.get_stride(), 4))
+    if rect is not None:
+        x, y, w, h = rect
+        words = words[y:y+h, x:x+w]
+    return words
+
+def pack(colour):
+    #a BGRA tuple as one 32 bit pixel value
+    return numpy.array(colour, numpy.uint8).view(numpy.uint32)[0]
+
+def unpremultiply(bgra):
+    # New straight alpha RGBA array from premultiplied BGRA pixels
+    if (bgra[..., 3] == 255).all():
+        #opaque pixels are the same either way
+        return bgra[..., [2, 1, 0, 3]]
+    alpha = bgra[..., 3:4].astype(numpy.uint32)
+    rgb = bgra[..., 2::-1].astype(numpy.uint32)
+    #fully transparent pixels are black in both forms
+    safe = numpy.maximum(alpha, 1)
+    rgba = numpy.empty(bgra.shape, numpy.uint8)
+    rgba[..., :3] = numpy.minimum((rgb*255+safe//2)//safe, 255)
+    rgba[..., 3] = bgra[..., 3]
+    return rgba
+
+def premultiply(rgba):
+    # New premultiplied BGRA array from straight RGBA (or opaque RGB) pixels
+    bgra = numpy.empty(rgba.shape[:-1]+(4,), numpy.uint8)
+    if rgba.shape[-1] == 4 and not (rgba[..., 3] == 255).all():
+        #255*255+127 still fits 16 bits
+        alpha = rgba[..., 3:4].astype(numpy.uint16)
+        bgra[..., :3] = (rgba[..., 2::-1]*alpha+127)//255
+        bgra[..., 3] = rgba[..., 3]
+    else:
+        #opaque pixels are the same either way
+        bgra[..., :3] = rgba[..., 2::-1]
+        bgra[..., 3] = 255
+    return bgra
+
+def premultiplied_colour(color):
+    #BGRA tuple of an RGBAColor as cairo stores it
+    a = color.get_alpha()
+    return (int(a*color.get_blue()*255), int(a*color.get_green()*255),
+            int(a*color.get_red()*255), int(a*255))
+
+def pixel_rgba(surface, x, y):
+    #straight (red, green, blue, alpha) of one pixel, each from 0 to 1
+    rgba = unpremultiply(surface_array(surface, (x, y, 1, 1)))[0, 0]
+    return [float(c)/255 for c in rgba]
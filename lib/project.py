@@ -0,0 +1,404 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Dappy's own .dappy project files. A project holds the tiles of the image
+# as they are kept in memory (premultiplied ARGB, each optionally zlib
+# compressed) and the undo history, so nothing is lost between sessions.
+#
+# The file is a header, then tile data, then a zlib compressed JSON index
+# saying where every tile is, then a footer pointing at the index:
+#
+#   header: "DAPPYPRJ" version
+#   tiles...
+#   index
+#   footer: index offset, index length, "DAPPYEND"
+#
+# Saving over a project that was opened or saved from this session only
+# appends the tiles it doesn't hold yet, then a new index and footer. The
+# last complete footer is the one used, so a save that is cut short leaves
+# the project as it was before. Once less than half of the file is still
+# used the next save writes it afresh. Tiles are recognised as already held
+# by a digest of their pixels, which the index keeps for the next session,
+# or for undo tiles kept compressed or in the journal by being the same
+# object. Neither keeps the tiles themselves alive.
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+import weakref
+import zlib
+from tiles import TiledImage, uniform_tile, is_shared, BPP
+from undo import UndoStep, JournalTile, CompressedTile
+from file_io import ReaderWriter
+
+MAGIC = "DAPPYPRJ"
+FOOTER_MAGIC = "DAPPYEND"
+VERSION = 1
+HEADER = struct.Struct(">8sI")
+FOOTER = struct.Struct(">QQ8s")
+# Share of a project that must still be used for a save to append to it
+MIN_LIVE = 0.5
+# zlib level of compressed tiles, tiles that don't shrink are kept raw
+COMPRESS_LEVEL = 1
+
+class ProjectError(IOError):
+    pass
+
+class ProjectTile(JournalTile):
+    # A tile of the undo history left in a project file until it is needed
+    def __init__(self, project, offset, length, compressed):
+        self.journal = project
+        self.offset = offset
+        self.length = length
+        self.compressed = compressed
+
+class ProjectFile:
+    # A project on disk. Its tile data is mapped into memory when first
+    # read, so only the pages of tiles actually used are ever loaded.
+    # digests maps the digest of the plain tiles it holds to their refs, and
+    # known the compressed and journal tiles (weakly) to theirs. size and
+    # footer are what the file should end with if nothing else has written
+    # to it since.
+    filename = None
+    file = None
+    map = None
+    size = None
+    footer = None
+    known = None
+    digests = None
+    live = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.known = weakref.WeakKeyDictionary()
+        self.digests = {}
+
+    def read(self, offset, length):
+        if self.map is None:
+            self.file = open(self.filename, "rb")
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:offset+length]
+
+    def is_unchanged(self):
+        #whether the file on disk is still the one this session last wrote
+        if self.footer is None:
+            return False
+        try:
+            if os.path.getsize(self.filename) != self.size:
+                return False
+            f = open(self.filename, "rb")
+            try:
+                f.seek(self.size-FOOTER.size)
+                return f.read(FOOTER.size) == self.footer
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return False
+
+    def load(self):
+        # (image, steps, redos) of the project. Image tiles are copied out of
+        # the file now, undo tiles only when undo needs them.
+        magic, version = HEADER.unpack(self.read(0, HEADER.size))
+        if magic != MAGIC:
+            raise ProjectError("Not a Dappy project: %s" % self.filename)
+        if version > VERSION:
+            raise ProjectError("Project saved by a newer Dappy: %s" % self.filename)
+        index = self.__read_index()
+        ts = index["tile_size"]
+        image = TiledImage(index["width"], index["height"], ts)
+        stored = index.get("digests")
+        if stored is not None:
+            for key, ref in stored.iteritems():
+                self.digests[key.decode("hex")] = ref
+        for tx, ty, ref in index["tiles"]:
+            tile = self.__load_tile(ref, ts)
+            if stored is None and ref is not None and ref[0] != "u":
+                #projects saved before the index kept them
+                self.digests[digest(tile)] = ref
+            image.set_tile((tx, ty), tile)
+        steps = [self.__load_step(step, ts) for step in index["steps"]]
+        redos = [self.__load_step(step, ts) for step in index["redos"]]
+        return image, steps, redos
+
+    def __read_index(self):
+        #the last footer whose index reads back, a save may have been cut short
+        end = len(self.map)
+        while end >= HEADER.size+FOOTER.size:
+            footer = self.map[end-FOOTER.size:end]
+            offset, length, magic = FOOTER.unpack(footer)
+            if magic == FOOTER_MAGIC and offset+length == end-FOOTER.size:
+                try:
+                    index = json.loads(zlib.decompress(self.map[offset:offset+length]))
+                except (zlib.error, ValueError):
+                    index = None
+                if index is not None:
+                    self.size = end
+                    self.footer = footer
+                    self.live = index.get("live", 0)
+                    return index
+            end = self.map.rfind(FOOTER_MAGIC, 0, end-1)
+            if end < 0:
+                break
+            end += len(FOOTER_MAGIC)
+        raise ProjectError("Damaged Dappy project: %s" % self.filename)
+
+    def __load_tile(self, ref, ts):
+        if ref is None:
+            return None
+        if ref[0] == "u":
+            return uniform_tile(ref[1].decode("hex"), ts)
+        offset, length, compressed = ref
+        tile = self.read(offset, length)
+        if compressed:
+            tile = zlib.decompress(tile)
+        return tile
+
+    def __load_undo_tile(self, ref, ts):
+        if ref is None or ref[0] == "u":
+            return self.__load_tile(ref, ts)
+        return ProjectTile(self, ref[0], ref[1], bool(ref[2]))
+
+    def __load_step(self, data, ts):
+        step = UndoStep(tuple(data["before_size"]))
+        step.after_size = tuple(data["after_size"])
+        for tx, ty, ref in data["before"]:
+            step.before[(tx, ty)] = self.__load_undo_tile(ref, ts)
+        for tx, ty, ref in data["after"]:
+            step.after[(tx, ty)] = self.__load_undo_tile(ref, ts)
+        return step
+
+def digest(tile):
+    return hashlib.sha1(tile).digest()
+
+class ProjectWriter:
+    # Writes the tiles of one save and the index to a file at offset. Tiles
+    # the project (if any) already holds are pointed to rather than written.
+    project = None
+    file = None
+    offset = None
+    level = None
+    written = None
+    digests = None
+    known = None
+    live = None
+    done = None
+
+    def __init__(self, project, f, offset, level):
+        self.project = project
+        self.file = f
+        self.offset = offset
+        self.level = level
+        self.written = {}
+        self.digests = {}
+        self.known = weakref.WeakKeyDictionary()
+        self.live = set()
+
+    def finish(self, image, history, job=None):
+        # Write the tiles, index and footer, returning the footer
+        if history is None:
+            history = ([], [])
+        steps, redos = history
+        keys = image.get_keys()
+        total = max(len(keys)+sum([len(s.before)+len(s.after) for s in steps+redos]), 1)
+        self.done = 0
+        tiles = []
+        for key in keys:
+            tile = image.get_tile(key)
+            if tile is not image.empty:
+                tiles.append([key[0], key[1], self.__ref(tile, job, total)])
+        index = {
+            "width": image.width,
+            "height": image.height,
+            "tile_size": image.tile_size,
+            "metadata": {"generator": "Dappy", "saved": time.time()},
+            "tiles": tiles,
+            "steps": [self.__step(step, job, total) for step in steps],
+            "redos": [self.__step(step, job, total) for step in redos],
+        }
+        index["live"] = self.get_live()
+        index["digests"] = dict([(key.encode("hex"), ref) for key, ref in self.digests.iteritems()])
+        data = zlib.compress(json.dumps(index, separators=(",", ":")), 6)
+        footer = FOOTER.pack(self.offset, len(data), FOOTER_MAGIC)
+        self.file.write(data)
+        self.file.write(footer)
+        self.offset += len(data)+len(footer)
+        return footer
+
+    def get_live(self):
+        #bytes of tile data the index points to
+        return sum([length for offset, length in self.live])
+
+    def __step(self, step, job, total):
+        return {
+            "before_size": list(step.before_size),
+            "after_size": list(step.after_size),
+            "before": [[k[0], k[1], self.__ref(t, job, total)] for k, t in step.before.iteritems()],
+            "after": [[k[0], k[1], self.__ref(t, job, total)] for k, t in step.after.iteritems()],
+        }
+
+    def __ref(self, tile, job, total):
+        #where a tile is in the file, writing it there if it isn't yet
+        self.done += 1
+        if job is not None and self.done % 64 == 0:
+            job.set_encode_progress(float(self.done)/total)
+        if tile is None:
+            return None
+        if is_shared(tile):
+            return ["u", tile[:BPP].encode("hex")]
+        if id(tile) in self.written:
+            return self.written[id(tile)][1]
+        project = self.project
+        if isinstance(tile, ProjectTile) and project is not None and tile.journal is project:
+            ref = [tile.offset, tile.length, int(tile.compressed)]
+        elif isinstance(tile, (CompressedTile, JournalTile)):
+            if project is not None and tile in project.known:
+                ref = project.known[tile]
+            else:
+                ref = self.__write(tile)
+            self.known[tile] = ref
+        else:
+            #the canvas reads unchanged tiles afresh, so plain tiles are
+            #matched by their pixels
+            key = digest(tile)
+            if key in self.digests:
+                ref = self.digests[key]
+            elif project is not None and key in project.digests:
+                ref = project.digests[key]
+            else:
+                ref = self.__write(tile)
+            self.digests[key] = ref
+        #the snapshot being saved keeps the tile alive until the save is done
+        self.written[id(tile)] = (tile, ref)
+        self.live.add((ref[0], ref[1]))
+        return ref
+
+    def __write(self, tile):
+        if isinstance(tile, CompressedTile):
+            data, compressed = tile.data, 1
+        elif isinstance(tile, JournalTile):
+            #copied as it is stored, compressed or not
+            data, compressed = tile.journal.read(tile.offset, tile.length), int(tile.compressed)
+        else:
+            data, compressed = tile, 0
+            if self.level:
+                packed = zlib.compress(tile, self.level)
+                if len(packed) < len(tile):
+                    data, compressed = packed, 1
+        ref = [self.offset, len(data), compressed]
+        self.file.write(data)
+        self.offset += len(data)
+        return ref
+
+class ProjectReaderWriter(ReaderWriter):
+    # projects holds the ProjectFile of each project opened or saved, so
+    # saving it again can append to it
+    TILED = True
+    level = None
+    projects = None
+
+    def __init__(self, compress=False):
+        if compress:
+            self.level = COMPRESS_LEVEL
+        else:
+            self.level = 0
+        self.projects = {}
+
+
+    def read(self, canonical_filename):
+        #also gives the image's undo history, for the canvas to take on
+        project = ProjectFile(canonical_filename)
+        image, steps, redos = project.load()
+        self.projects[canonical_filename] = project
+        return (canonical_filename, image.to_surface(), (steps, redos))
+
+
+    def write(self, image, canonical_filename):
+        f = open(canonical_filename, "wb")
+        try:
+            self.__write_new(TiledImage.from_surface(image), f, None, canonical_filename)
+        finally:
+            f.close()
+
+
+    def write_file(self, image, f, job=None):
+        self.write_tiles(TiledImage.from_surface(image), f, job)
+
+
+    def write_tiles(self, image, f, job=None):
+        if job is None:
+            self.__write_new(image, f, None, None)
+        else:
+            self.__write_new(image, f, job, job.filename)
+
+
+    def __write_new(self, image, f, job, filename):
+        f.write(HEADER.pack(MAGIC, VERSION))
+        writer = ProjectWriter(None, f, HEADER.size, self.level)
+        history = None
+        if job is not None:
+            history = job.history
+        footer = writer.finish(image, history, job)
+        if filename is not None:
+            #the tiles are only at these offsets once the file is in place,
+            #appending checks the footer on disk before trusting them
+            project = ProjectFile(filename)
+            project.size = writer.offset
+            project.footer = footer
+            project.known = writer.known
+            project.digests = writer.digests
+            project.live = writer.get_live()
+            self.projects[filename] = project
+
+
+    def can_append(self, canonical_filename):
+        project = self.projects.get(canonical_filename)
+        if project is None or not project.is_unchanged():
+            return False
+        #a file mostly made of tiles nothing uses any more is written afresh
+        return project.live >= MIN_LIVE*project.size
+
+
+    def append(self, image, canonical_filename, job=None):
+        # Add what the project doesn't hold to the end of it. If anything
+        # goes wrong it is cut back to how it was.
+        project = self.projects[canonical_filename]
+        f = open(canonical_filename, "r+b")
+        try:
+            f.seek(project.size)
+            writer = ProjectWriter(project, f, project.size, self.level)
+            history = None
+            if job is not None:
+                history = job.history
+            try:
+                footer = writer.finish(image, history, job)
+                f.flush()
+                os.fsync(f.fileno())
+            except:
+                f.truncate(project.size)
+                raise
+        finally:
+            f.close()
+        project.size = writer.offset
+        project.footer = footer
+        project.known = writer.known
+        project.digests = writer.digests
+        project.live = writer.get_live()
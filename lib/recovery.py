@@ -0,0 +1,177 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+# Autosaving to a recovery file while Dappy runs, and offering the image back
+# at the next start if Dappy didn't close properly. Each session has its own
+# recovery file, a .dappy project named after the process id, which is
+# removed again when the session ends normally. Images that aren't recovered
+# are set aside in the same directory rather than removed.
+
+import os
+import errno
+import glob
+import time
+import gtk
+import gobject
+from project import ProjectReaderWriter
+from saving import SaveJob
+
+# Seconds between checks for changes to autosave
+AUTOSAVE_INTERVAL = 30
+RECOVERY_DIR = os.path.join(os.path.expanduser("~"), ".dappy", "recovery")
+
+def recovery_filename(pid):
+    return os.path.join(RECOVERY_DIR, "recovery-%d.dappy" % pid)
+
+def set_aside(filename):
+    # Rename a recovery file so it is no longer offered, keeping it to be
+    # opened by hand. The time keeps it apart from a later session that gets
+    # the same process id.
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(filename)))
+    os.rename(filename, os.path.join(RECOVERY_DIR, "declined-%s-%s" % (stamp, os.path.basename(filename))))
+
+def is_running(pid):
+    if os.name == "nt":
+        #signal 0 isn't a harmless check on windows, assume the session lives
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        #it exists but belongs to someone else
+        return e.errno == errno.EPERM
+    return True
+
+def find_orphans():
+    # Recovery files of sessions that are no longer running, newest first
+    orphans = []
+    for filename in glob.glob(os.path.join(RECOVERY_DIR, "recovery-*.dappy")):
+        try:
+            pid = int(os.path.basename(filename)[len("recovery-"):-len(".dappy")])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not is_running(pid):
+            orphans.append((os.path.getmtime(filename), filename))
+    orphans.sort(reverse=True)
+    return [filename for mtime, filename in orphans]
+
+def recover():
+    # Offer the images of sessions that ended without closing, newest first,
+    # until one is taken. Returns its info as FileIO.read does, or None. The
+    # ones turned down are set aside, those not asked about yet are offered
+    # again at the next start.
+    for filename in find_orphans():
+        when = time.strftime("%c", time.localtime(os.path.getmtime(filename)))
+        question = gtk.MessageDialog(None, 0, gtk.MESSAGE_QUESTION, gtk.BUTTONS_YES_NO,
+                                     "Dappy did not close properly. Recover the image autosaved %s?" % when)
+        question.format_secondary_text("Images that aren't recovered are kept in %s" % RECOVERY_DIR)
+        answer = question.run()
+        question.destroy()
+        info = None
+        if answer == gtk.RESPONSE_YES:
+            try:
+                info = ProjectReaderWriter().read(filename)
+            except (IOError, OSError), e:
+                error = gtk.MessageDialog(None, 0, gtk.MESSAGE_ERROR, gtk.BUTTONS_OK, "Could not recover the image: %s" % e)
+                error.run()
+                error.destroy()
+        try:
+            if info is None:
+                set_aside(filename)
+            else:
+                #kept as this session's recovery file until the first
+                #autosave replaces it
+                os.rename(filename, recovery_filename(os.getpid()))
+        except OSError:
+            pass
+        if info is not None:
+            return info
+    return None
+
+class Autosaver:
+    # Saves the canvas to this session's recovery file every interval while
+    # it has changes the file lacks. The file is a project appended to by
+    # each autosave, so only tiles changed since the last one are written,
+    # on a worker thread, however big the image.
+    canvas = None
+    filename = None
+    writer = None
+    job = None
+    job_revision = None
+    saved_revision = None
+    source = None
+    status = None
+
+    def __init__(self, canvas, interval=AUTOSAVE_INTERVAL):
+        self.canvas = canvas
+        self.filename = recovery_filename(os.getpid())
+        #kept apart from the project format's writer, which the user's own
+        #saves append through
+        self.writer = ProjectReaderWriter()
+        self.saved_revision = canvas.get_revision()
+        self.source = gobject.timeout_add_seconds(interval, self.autosave)
+
+    def set_status_callback(self, status):
+        #status(error) is called in the main thread after each autosave,
+        #with error None once the file is written
+        self.status = status
+
+    def autosave(self):
+        revision = self.canvas.get_revision()
+        #a preview's image is blank until the full image arrives
+        if self.job is None and revision != self.saved_revision and not self.canvas.is_preview():
+            try:
+                if not os.path.isdir(RECOVERY_DIR):
+                    os.makedirs(RECOVERY_DIR)
+                #a paste still being moved is left out rather than placed
+                self.job = SaveJob(self.canvas.snapshot(False), self.filename, self.writer,
+                                   gobject.idle_add, None, self.__saved, self.canvas.snapshot_history())
+                self.job_revision = revision
+                self.job.start()
+            except (IOError, OSError), e:
+                #an exception would remove the timeout, try again next time
+                self.job = None
+                self.__report(e)
+        return True
+
+    def __saved(self, job):
+        if job.error is None and not job.cancelled:
+            self.saved_revision = self.job_revision
+        self.job = None
+        if not job.cancelled:
+            self.__report(job.error)
+
+    def __report(self, error):
+        if self.status is not None:
+            self.status(error)
+
+    def discard(self):
+        # Remove the recovery file, when Dappy closes normally or the image
+        # is thrown away
+        if self.job is not None:
+            self.job.cancel()
+            self.job.join()
+            self.job = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.writer.projects.clear()
+        self.saved_revision = self.canvas.get_revision()
+
+    def stop(self):
+        gobject.source_remove(self.source)
+        self.discard()
@@ -0,0 +1,101 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import math
+
+# Rectangles are (x, y, width, height) tuples of integers. An empty rectangle
+# has zero width or height. Where a rectangle can be "everything" (eg. the
+# whole canvas must be redrawn) None is used instead.
+EMPTY = (0, 0, 0, 0)
+
+def is_empty(rect):
+    return rect is not None and (rect[2] <= 0 or rect[3] <= 0)
+
+def union(a, b):
+    #None is the whole canvas so it swallows everything
+    if a is None or b is None:
+        return None
+    if is_empty(a):
+        return b
+    if is_empty(b):
+        return a
+    x0 = min(a[0], b[0])
+    y0 = min(a[1], b[1])
+    x1 = max(a[0]+a[2], b[0]+b[2])
+    y1 = max(a[1]+a[3], b[1]+b[3])
+    return (x0, y0, x1-x0, y1-y0)
+
+def intersect(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0]+a[2], b[0]+b[2])
+    y1 = min(a[1]+a[3], b[1]+b[3])
+    if x1 <= x0 or y1 <= y0:
+        return EMPTY
+    return (x0, y0, x1-x0, y1-y0)
+
+def from_points(points, pad=0):
+    #bounding box of a list of (x,y) points, grown by pad on every side and
+    #rounded outwards to whole pixels
+    if not points:
+        return EMPTY
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    x0 = int(math.floor(min(xs)-pad))
+    y0 = int(math.floor(min(ys)-pad))
+    x1 = int(math.ceil(max(xs)+pad))+1
+    y1 = int(math.ceil(max(ys)+pad))+1
+    return (x0, y0, x1-x0, y1-y0)
+
+def from_corners(xa, ya, xb, yb, pad=0):
+    return from_points([(xa, ya), (xb, yb)], pad)
+
+class Damage:
+    # Accumulates the bounding box of everything that needs repainting
+    # until it is taken by whoever does the repaint.
+    rect = None
+    full = None
+
+    def __init__(self):
+        self.reset()
+
+    def add(self, rect):
+        if rect is None:
+            self.full = True
+        elif not self.full:
+            self.rect = union(self.rect, rect)
+
+    def is_clean(self):
+        return not self.full and is_empty(self.rect)
+
+    def take(self):
+        if self.full:
+            rect = None
+        else:
+            rect = self.rect
+        self.reset()
+        return rect
+
+    def reset(self):
+        self.full = False
+        self.rect = EMPTY
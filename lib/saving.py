@@ -0,0 +1,165 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import tempfile
+import threading
+import cairo
+
+# Share of the progress bar taken by copying tiles out, the rest is encoding
+ASSEMBLE_SHARE = 0.2
+
+#files made by mkstemp are private, saved images get the usual permissions
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+class SaveCancelled(Exception):
+    pass
+
+class JobFile:
+    # The file a writer is encoding into, each write checks whether the job
+    # has been cancelled so a large save stops soon after it is asked to.
+    job = None
+    file = None
+
+    def __init__(self, job, file):
+        self.job = job
+        self.file = file
+
+    def write(self, data):
+        if self.job.cancelled:
+            raise SaveCancelled()
+        self.file.write(data)
+
+class SaveJob(threading.Thread):
+    # Writes a TiledImage to a file on a worker thread. The image should be a
+    # copy (only its tile index is copied, tiles are never edited in place) so
+    # drawing can carry on while it is saved. The file is written beside the
+    # target under a temporary name and renamed over it once complete, so a
+    # failed or cancelled save leaves any old file untouched.
+    # progress(job, fraction) and done(job) are run with call_in_main.
+    image = None
+    filename = None
+    writer = None
+    call_in_main = None
+    progress = None
+    done = None
+    cancelled = None
+    error = None
+    history = None
+
+    def __init__(self, image, filename, writer, call_in_main, progress=None, done=None, history=None):
+        # history is a snapshot of the undo history, for formats that keep it
+        threading.Thread.__init__(self)
+        self.image = image
+        self.history = history
+        self.filename = filename
+        self.writer = writer
+        self.call_in_main = call_in_main
+        self.progress = progress
+        self.done = done
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def set_progress(self, fraction):
+        #called by the worker, raises SaveCancelled once cancelled
+        if self.cancelled:
+            raise SaveCancelled()
+        if self.progress is not None:
+            self.call_in_main(self.progress, self, fraction)
+
+    def set_encode_progress(self, fraction):
+        #progress of the writer through encoding the image, tiled writers
+        #have nothing to assemble first
+        if self.writer.TILED:
+            self.set_progress(fraction)
+        else:
+            self.set_progress(ASSEMBLE_SHARE+(1-ASSEMBLE_SHARE)*fraction)
+
+    def run(self):
+        try:
+            try:
+                if self.writer.can_append(self.filename):
+                    #the writer adds to the file in place and puts it back
+                    #as it was if that fails
+                    self.writer.append(self.image, self.filename, self)
+                else:
+                    self.__write_new()
+            except SaveCancelled:
+                self.cancelled = True
+            except Exception, e:
+                #whatever a writer raises fails the save, done must not take
+                #it for a finished one. cairo turns exceptions raised by
+                #JobFile into its own errors.
+                if not self.cancelled:
+                    self.error = e
+        finally:
+            if self.done is not None:
+                self.call_in_main(self.done, self)
+
+    def __write_new(self):
+        #the whole file, under a temporary name until it is complete
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        handle, temp = tempfile.mkstemp(prefix=".dappy-", suffix=".part", dir=directory)
+        try:
+            f = os.fdopen(handle, "wb")
+            try:
+                if self.writer.TILED:
+                    self.writer.write_tiles(self.image, JobFile(self, f), self)
+                else:
+                    self.writer.write_file(self.__assemble(), JobFile(self, f), self)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            self.__replace(temp)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def __assemble(self):
+        #surface of the image, copied a row of tiles at a time
+        image = self.image
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, image.width, image.height)
+        #new surfaces start transparent, only painted tiles need copying
+        rows = image.get_n_tiles()[1]
+        painted = image.get_keys()
+        for row in range(rows):
+            self.set_progress(ASSEMBLE_SHARE*row/rows)
+            keys = image.keys_in_rect((0, row*image.tile_size, image.width, 1))
+            image.write_surface(surface, [key for key in keys if key in painted])
+        self.set_progress(ASSEMBLE_SHARE)
+        return surface
+
+    def __replace(self, temp):
+        if os.path.exists(self.filename):
+            mode = os.stat(self.filename).st_mode & 0777
+        else:
+            mode = 0666 & ~UMASK
+        os.chmod(temp, mode)
+        #rename can't replace an existing file on windows
+        if os.name == "nt" and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(temp, self.filename)
@@ -0,0 +1,130 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import cairo
+import numpy
+import region
+import pixels
+from fill import mask_bounds, match_mask, mask_runs, runs_mask, grow_runs
+
+class Selection:
+    # A selected part of the image of any shape, kept as runs of selected
+    # pixels: one (row, start, end) line per run, end exclusive, in image
+    # coordinates. A rectangle costs one run a row and a magic wand region
+    # one run per span of it, whatever its area. Bounds is the box the runs
+    # lie in, everything that uses a selection only looks inside it.
+    runs = None
+    bounds = None
+
+    def __init__(self, runs, bounds):
+        self.runs = runs
+        self.bounds = bounds
+
+    @classmethod
+    def from_mask(cls, mask, x=0, y=0):
+        # The True pixels of a boolean array whose top left corner is at
+        # (x,y) in the image.
+        bx, by, bw, bh = mask_bounds(mask)
+        if bw == 0:
+            return cls(numpy.zeros((0, 3), numpy.int32), region.EMPTY)
+        rows, starts, ends = mask_runs(mask[by:by+bh, bx:bx+bw])
+        runs = numpy.column_stack((rows+by+y, starts+bx+x, ends+bx+x)).astype(numpy.int32)
+        return cls(runs, (bx+x, by+y, bw, bh))
+
+    @classmethod
+    def from_rect(cls, rect):
+        x, y, w, h = rect
+        if w <= 0 or h <= 0:
+            return cls(numpy.zeros((0, 3), numpy.int32), region.EMPTY)
+        runs = numpy.empty((h, 3), numpy.int32)
+        runs[:, 0] = numpy.arange(y, y+h)
+        runs[:, 1] = x
+        runs[:, 2] = x+w
+        return cls(runs, rect)
+
+    @classmethod
+    def from_polygon(cls, points, clip=None):
+        # The inside of a closed outline, only the part within clip is kept
+        bounds = region.intersect(region.from_points(points), clip)
+        if region.is_empty(bounds):
+            return cls(numpy.zeros((0, 3), numpy.int32), region.EMPTY)
+        bx, by, bw, bh = bounds
+        surface = cairo.ImageSurface(cairo.FORMAT_A8, bw, bh)
+        context = cairo.Context(surface)
+        context.set_antialias(cairo.ANTIALIAS_NONE)
+        context.translate(-bx, -by)
+        context.move_to(*points[0])
+        for point in points[1:]:
+            context.line_to(*point)
+        context.close_path()
+        context.fill()
+        return cls.from_mask(pixels.alpha_array(surface) > 0, bx, by)
+
+    @classmethod
+    def from_colour(cls, surface, x, y, tolerance=0):
+        # The pixels joined to (x,y) that are within tolerance of its colour
+        x = int(x)
+        y = int(y)
+        if x < 0 or y < 0 or x >= surface.get_width() or y >= surface.get_height():
+            return cls(numpy.zeros((0, 3), numpy.int32), region.EMPTY)
+        colour = tuple(pixels.surface_array(surface, (x, y, 1, 1))[0, 0])
+        mask = match_mask(surface, None, colour, tolerance)
+        runs, bounds = grow_runs(mask, x, y)
+        return cls(runs, bounds)
+
+    def is_empty(self):
+        return len(self.runs) == 0
+
+    def get_bounds(self):
+        return self.bounds
+
+    def get_area(self):
+        return int((self.runs[:, 2]-self.runs[:, 1]).sum())
+
+    def is_rect(self):
+        return self.get_area() == self.bounds[2]*self.bounds[3]
+
+    def clip(self, rect):
+        #the part of the selection inside rect
+        x, y, w, h = rect
+        runs = self.runs[(self.runs[:, 0] >= y) & (self.runs[:, 0] < y+h)].copy()
+        runs[:, 1:] = numpy.clip(runs[:, 1:], x, x+w)
+        runs = runs[runs[:, 2] > runs[:, 1]]
+        if len(runs) == 0:
+            return Selection(runs, region.EMPTY)
+        bounds = (int(runs[:, 1].min()), int(runs[:, 0].min()),
+                  int(runs[:, 2].max()-runs[:, 1].min()), int(runs[:, 0].max()-runs[:, 0].min()+1))
+        return Selection(runs, bounds)
+
+    def contains(self, x, y):
+        x = int(x)
+        y = int(y)
+        runs = self.runs[self.runs[:, 0] == y]
+        return bool(((runs[:, 1] <= x) & (x < runs[:, 2])).any())
+
+    def to_mask(self):
+        #boolean array covering bounds
+        return runs_mask(self.runs, self.bounds)
+
+    def to_surface(self):
+        #FORMAT_A8 surface of the mask, to paint through at the bounds
+        surface = cairo.ImageSurface(cairo.FORMAT_A8, self.bounds[2], self.bounds[3])
+        pixels.alpha_array(surface)[self.to_mask()] = 255
+        surface.mark_dirty()
+        return surface
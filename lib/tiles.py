@@ -0,0 +1,327 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import threading
+import weakref
+import cairo
+import region
+from collections import OrderedDict
+
+TILE_SIZE = 256
+BPP = 4
+# Uniform tiles of colours kept for sharing, besides the empty ones
+MAX_UNIFORM_TILES = 32
+EMPTY_PIXEL = '\0'*BPP
+
+# Tiles made of a single repeated pixel (eg. a blank background) are shared by
+# every image, keyed by that pixel. Only the most recently used colours are
+# kept, a tile dropped from the cache lives on as an ordinary tile wherever
+# it is still used. The empty tiles are always kept, as images compare tiles
+# with theirs.
+empty_tiles = {}
+uniform_tiles = OrderedDict()
+shared_ids = set()
+
+def is_shared(tile):
+    #tiles in the cache cost nothing extra wherever they are referenced
+    return tile is None or id(tile) in shared_ids
+
+def uniform_tile(pixel, tile_size=TILE_SIZE):
+    key = (pixel, tile_size)
+    if pixel == EMPTY_PIXEL:
+        cache = empty_tiles
+    else:
+        cache = uniform_tiles
+    tile = cache.pop(key, None)
+    if tile is None:
+        tile = pixel*(tile_size*tile_size)
+        shared_ids.add(id(tile))
+    #most recently used at the end
+    cache[key] = tile
+    if len(uniform_tiles) > MAX_UNIFORM_TILES:
+        old_key, old = uniform_tiles.popitem(last=False)
+        shared_ids.discard(id(old))
+    return tile
+
+class TiledImage:
+    # The image split into square tiles of premultiplied ARGB data, the same
+    # layout as a cairo FORMAT_ARGB32 surface with a stride of tile_size*4.
+    # Tiles are immutable strings: changing the image replaces tiles rather
+    # than editing them, so they can be shared freely with undo steps and
+    # snapshots. Tiles that have never been painted are not stored at all and
+    # read back as the shared empty tile.
+    #
+    # An image made over_surface stands in for a surface without a copy of
+    # it: the tiles of keys in live are left in source and only read when
+    # they are asked for. Whatever draws on source has to hold() the area
+    # first, while the tiles there are still as they were.
+    #
+    # Copies leave the same tiles live, so snapshots cost no more than the
+    # index. watchers are the copies sharing source, and a tile stopping
+    # being live anywhere is handed to those where it still is before it
+    # can be drawn over. Copies may be read on other threads, lock keeps a
+    # tile from being drawn over while one of them reads it.
+    width = None
+    height = None
+    tile_size = None
+    tiles = None
+    empty = None
+    source = None
+    live = None
+    watchers = None
+    lock = None
+
+    def __init__(self, width, height, tile_size=TILE_SIZE):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tiles = {}
+        self.empty = uniform_tile(EMPTY_PIXEL, tile_size)
+        self.live = set()
+        self.watchers = weakref.WeakSet()
+        self.lock = threading.RLock()
+
+    @classmethod
+    def from_surface(cls, surface, tile_size=TILE_SIZE):
+        image = cls(surface.get_width(), surface.get_height(), tile_size)
+        image.read_surface(surface)
+        return image
+
+    @classmethod
+    def over_surface(cls, surface, tile_size=TILE_SIZE):
+        image = cls(surface.get_width(), surface.get_height(), tile_size)
+        image.set_source(surface)
+        image.live = set(image.keys_in_rect(None))
+        return image
+
+    def get_size(self):
+        return (self.width, self.height)
+
+    def get_n_tiles(self):
+        ts = self.tile_size
+        return ((self.width+ts-1)//ts, (self.height+ts-1)//ts)
+
+    def tile_rect(self, key):
+        #the part of the image a tile covers, edge tiles are clipped
+        ts = self.tile_size
+        x = key[0]*ts
+        y = key[1]*ts
+        return (x, y, min(ts, self.width-x), min(ts, self.height-y))
+
+    def keys_in_rect(self, rect=None):
+        rect = region.intersect(rect, (0, 0, self.width, self.height))
+        if region.is_empty(rect):
+            return []
+        ts = self.tile_size
+        x0 = rect[0]//ts
+        y0 = rect[1]//ts
+        x1 = (rect[0]+rect[2]-1)//ts
+        y1 = (rect[1]+rect[3]-1)//ts
+        return [(tx, ty) for ty in range(y0, y1+1) for tx in range(x0, x1+1)]
+
+    def get_tile(self, key):
+        if key in self.live:
+            self.lock.acquire()
+            try:
+                if key in self.live:
+                    #kept from now on, the surface may be drawn over next
+                    self.set_tile(key, self.__unlive(key, self.read_tile(self.source, key)))
+            finally:
+                self.lock.release()
+        return self.tiles.get(key, self.empty)
+
+    def get_keys(self):
+        #keys of the tiles that may be painted, live ones included
+        self.lock.acquire()
+        try:
+            return set(self.tiles).union(self.live)
+        finally:
+            self.lock.release()
+
+    def hold(self, rect=None):
+        #read the live tiles touching rect (None for all) out of the surface
+        if self.live:
+            for key in self.keys_in_rect(rect):
+                if key in self.live:
+                    self.get_tile(key)
+
+    def hold_edges(self, width, height):
+        #read the live tiles a resize to width by height would cut down
+        ts = self.tile_size
+        w = min(width, self.width)
+        h = min(height, self.height)
+        for key in list(self.live):
+            if (key[0]+1)*ts > w or (key[1]+1)*ts > h:
+                self.get_tile(key)
+
+    def set_source(self, surface):
+        # A new surface with the same pixels wherever tiles are live. Copies
+        # keep the old one, which is no longer drawn on.
+        surface.flush()
+        self.source = surface
+        self.watchers = weakref.WeakSet()
+        self.lock = threading.RLock()
+
+    def __unlive(self, key, tile=None):
+        # Stop key being live here, first giving the copies where it still
+        # is the tile as it is in source. Returns the tile if it was read.
+        self.lock.acquire()
+        try:
+            self.live.discard(key)
+            waiting = [image for image in self.watchers if key in image.live]
+            if waiting and tile is None:
+                tile = self.read_tile(self.source, key)
+            for image in waiting:
+                image.live.discard(key)
+                image.__store(key, tile)
+        finally:
+            self.lock.release()
+        return tile
+
+    def set_tile(self, key, tile):
+        if key in self.live:
+            self.__unlive(key)
+        self.__store(key, tile)
+
+    def __store(self, key, tile):
+        if tile is None or tile is self.empty:
+            self.tiles.pop(key, None)
+        else:
+            self.tiles[key] = tile
+
+    def copy(self):
+        # Tiles are never edited in place so a copy only duplicates the index,
+        # live tiles stay live in it until they are read or drawn over
+        image = TiledImage(self.width, self.height, self.tile_size)
+        image.tiles = dict(self.tiles)
+        if self.live:
+            self.lock.acquire()
+            try:
+                self.source.flush()
+                image.source = self.source
+                image.live = set(self.live)
+                image.watchers = self.watchers
+                image.lock = self.lock
+                self.watchers.add(image)
+            finally:
+                self.lock.release()
+        return image
+
+    def get_memory_size(self):
+        #bytes held by tiles, shared tiles are not counted
+        size = 0
+        for tile in self.tiles.itervalues():
+            if not is_shared(tile):
+                size += len(tile)
+        return size
+
+    def resize(self, width, height):
+        # Change the image size, returning {key: (old_tile, new_tile)} for the
+        # tiles that were cut down or dropped.
+        changes = {}
+        if (width, height) == (self.width, self.height):
+            return changes
+        self.hold_edges(width, height)
+        ts = self.tile_size
+        for key in self.tiles.keys():
+            old = self.tiles[key]
+            x, y = key[0]*ts, key[1]*ts
+            if x >= width or y >= height:
+                self.set_tile(key, None)
+            elif x+ts > width or y+ts > height:
+                #pixels outside the new size must not come back if it grows
+                self.set_tile(key, self.__crop_tile(old, width-x, height-y))
+            if self.get_tile(key) != old:
+                changes[key] = (old, self.get_tile(key))
+        self.width = width
+        self.height = height
+        return changes
+
+    def __crop_tile(self, tile, w, h):
+        ts = self.tile_size
+        w = min(w, ts)
+        h = min(h, ts)
+        pad = '\0'*((ts-w)*BPP)
+        rows = [tile[r*ts*BPP:r*ts*BPP+w*BPP]+pad for r in range(h)]
+        rows.append('\0'*((ts-h)*ts*BPP))
+        return self.__share(''.join(rows))
+
+    def __share(self, tile):
+        #return the shared copy of uniform tiles
+        pixel = tile[:BPP]
+        if tile.count(pixel) == self.tile_size*self.tile_size:
+            return uniform_tile(pixel, self.tile_size)
+        return tile
+
+    def read_tile(self, surface, key):
+        #copy one tile out of a surface the same size as the image
+        ts = self.tile_size
+        x, y, w, h = self.tile_rect(key)
+        data = surface.get_data()
+        stride = surface.get_stride()
+        pad = '\0'*((ts-w)*BPP)
+        rows = [data[(y+r)*stride+x*BPP:(y+r)*stride+(x+w)*BPP]+pad for r in range(h)]
+        if h < ts:
+            rows.append('\0'*((ts-h)*ts*BPP))
+        return self.__share(''.join(rows))
+
+    def read_surface(self, surface, rect=None):
+        # Copy the tiles touching rect (None for all) from a surface and
+        # return {key: (old_tile, new_tile)} for the tiles that changed.
+        changes = self.resize(surface.get_width(), surface.get_height())
+        surface.flush()
+        for key in self.keys_in_rect(rect):
+            if key in self.live:
+                #nothing has been drawn where tiles are still live
+                continue
+            old = self.get_tile(key)
+            new = self.read_tile(surface, key)
+            if new != old:
+                self.set_tile(key, new)
+                #keep the tile from before any resize
+                changes[key] = (changes.get(key, (old,))[0], new)
+        return changes
+
+    def write_surface(self, surface, keys=None):
+        #copy tiles (all of them if keys is None) into a surface of the same size
+        if keys is None:
+            keys = self.keys_in_rect(None)
+        ts = self.tile_size
+        surface.flush()
+        data = surface.get_data()
+        stride = surface.get_stride()
+        for key in keys:
+            tile = self.get_tile(key)
+            x, y, w, h = self.tile_rect(key)
+            for r in range(h):
+                data[(y+r)*stride+x*BPP:(y+r)*stride+(x+w)*BPP] = tile[r*ts*BPP:r*ts*BPP+w*BPP]
+        surface.mark_dirty()
+
+    def to_surface(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        #only painted tiles need copying, new surfaces start transparent
+        self.write_surface(surface, self.tiles.keys())
+        if self.live:
+            context = cairo.Context(surface)
+            context.set_operator(cairo.OPERATOR_SOURCE)
+            context.set_source_surface(self.source)
+            for key in self.live:
+                context.rectangle(*self.tile_rect(key))
+            context.fill()
+        return surface
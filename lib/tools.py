@@ -20,10 +20,13 @@
 
 import gtk
 import cairo
-import struct
 import math
+import region
+import fill
+import brushes
+import pixels
 from colors import RGBAColor
-from ctypes import create_string_buffer
+from selection import Selection
 
 # Class
 # ==============================================================================
@@ -55,7 +58,7 @@ class Tool(gtk.Object):
 
     def begin(self, x, y,button):
         self.canvas.clear_overlay()
-        self.canvas.update_undo_buffer(1)
+        self.canvas.begin_undo_step()
         self.mode = self.DRAWING
 
     def end(self, x, y):
@@ -63,6 +66,14 @@ class Tool(gtk.Object):
 
     def draw(self, context): pass
 
+    def get_bounds(self):
+        #The area covered by what the tool draws now, None is the whole canvas
+        return None
+
+    def get_damage(self):
+        #The area that changed since the last call, None is the whole canvas
+        return None
+
     def __use_color(self, context, color):
         context.set_source_rgba(color.get_red(), color.get_green(),
            color.get_blue(), color.get_alpha())
@@ -96,6 +107,12 @@ class Tool(gtk.Object):
         self.mode = self.READY
 
 
+class DummyTool(Tool):
+    # Stands in for clicks that land off the image and its scaling points
+    def get_damage(self):
+        return region.EMPTY
+
+
 # Class
 # ==============================================================================
 class DragAndDropTool(Tool):
@@ -106,6 +123,7 @@ class DragAndDropTool(Tool):
     final_x = 0
     final_y = 0
     m_button = None
+    last_bounds = region.EMPTY
 
     def set_cursor(self):
         self.CURSOR = gtk.gdk.Cursor(gtk.gdk.CROSSHAIR)
@@ -117,6 +135,14 @@ class DragAndDropTool(Tool):
         self.final_x = x
         self.final_y = y
         self.m_button=button
+        self.last_bounds = region.EMPTY
+
+    def get_damage(self):
+        #Both the previous and current shape have to be repainted
+        bounds = self.get_bounds()
+        damage = region.union(self.last_bounds, bounds)
+        self.last_bounds = bounds
+        return damage
 
 
     def end(self, x, y):
@@ -130,6 +156,31 @@ class DragAndDropTool(Tool):
         self.final_y = y
 
 
+# Class
+# ==============================================================================
+class ZoomTool(Tool):
+    # Left click zooms in, right click zooms out, about the clicked point
+    name = 'Zoom'
+
+    def set_cursor(self):
+        self.CURSOR = gtk.gdk.Cursor(gtk.gdk.PLUS)
+
+    def begin(self, x, y,button):
+        #the image isn't touched so neither the overlay nor undo are
+        self.mode = self.DRAWING
+        if button==3:
+            self.canvas.set_zoom(self.canvas.zoom/2, x, y)
+        else:
+            self.canvas.set_zoom(self.canvas.zoom*2, x, y)
+
+    def get_damage(self):
+        #set_zoom repaints the view
+        return region.EMPTY
+
+    def commit(self):
+        self.mode = self.READY
+
+
 # Class
 # ==============================================================================
 class BothScalingTool(Tool):
@@ -179,11 +230,6 @@ class VerticalScalingTool(Tool):
 
 class ColorPickerTool(DragAndDropTool):
     name = 'ColorPicker';
-    pixels = None;
-    data = None;
-    bpp= None;
-    w = None;
-    s = None;
     col = None;
 
     def set_cursor(self):
@@ -192,82 +238,68 @@ class ColorPickerTool(DragAndDropTool):
     def begin(self, x, y,button):
         self.mode = self.DRAWING
         self.m_button=button
-        surface = self.canvas.get_image()
-        self.w = surface.get_width()
-        self.h = surface.get_height()
-        self.s = surface.get_stride()
-        self.bpp = self.s/self.w
-        self.data = surface.get_data()
-        act_px = int(y*self.s+x*self.bpp)
-        col_bin = self.data[act_px:act_px+4]
-        col_int = struct.unpack_from(str(self.bpp)+'B',col_bin)
-        self.col = [float(i)/255 for i in col_int]
+        self.col = None
+        self.pick(x, y)
 
     def end(self, x, y):
         self.mode = self.READY
 
+    def get_damage(self):
+        #picking colours doesn't change the canvas
+        return region.EMPTY
+
     def move(self, x, y):
         if self.mode == self.DRAWING:
-            if x<self.w and y<self.h and x>=0 and y>=0:
-                act_px = int(y*self.s+x*self.bpp)
-                col_bin = self.data[act_px:act_px+4]
-                col_int = struct.unpack_from(str(self.bpp)+'B',col_bin)
-                self.col = [float(i)/255 for i in col_int]
+            self.pick(x, y)
+
+    def pick(self, x, y):
+        #straight RGBA of the pixel under the cursor, left alone off the image
+        surface = self.canvas.get_image()
+        x = int(x)
+        y = int(y)
+        if x<surface.get_width() and y<surface.get_height() and x>=0 and y>=0:
+            self.col = pixels.pixel_rgba(surface, x, y)
 
 
 class BucketFillTool(Tool):
     name = 'BucketFill';
+    bounds = None
 
     def set_cursor(self):
         self.set_cursor_from_file('Cursors/cursor-bucket-fill.png',1,35)
 
     def begin(self, x, y,button):
+        #starting the tool drops the selection, so keep it for the fill
+        selection = self.canvas.selection
         Tool.begin(self, x, y,button)
         self.mode = self.DRAWING
         surface = self.canvas.get_image()
-        w = surface.get_width()
-        h = surface.get_height()
-        s = surface.get_stride()
-        bpp = s/w
-        data = surface.get_data()
 
         if button==3:
             pc=self.canvas.secondary
         else:
             pc = self.canvas.primary
-        act_px = int(y*s+x*bpp)
-        orr_c = data[act_px:act_px+bpp]
-        rep_c = create_string_buffer(bpp)
-        struct.pack_into(str(bpp)+'B',rep_c,0,int(pc.get_alpha()*pc.get_blue()*255), int(pc.get_alpha()*pc.get_green()*255),
-                         int(pc.get_alpha()*pc.get_red()*255), int(pc.get_alpha()*255))
-
-        if orr_c != rep_c[0:bpp]:
-            pxstack = [-1] * (h*w*bpp)
-            pxstack[0] = act_px
-            readc=0
-            writec=1
-            while pxstack[readc]!=-1:
-                act_px = pxstack[readc]
-                readc+=1
-                if data[act_px:act_px+bpp]==orr_c:
-                    data[act_px:act_px+bpp]=rep_c
-                    if act_px-s>=0:
-                        pxstack[writec]=(act_px-s)
-                        writec+=1
-                    if act_px+s<s*h:
-                        pxstack[writec]=(act_px+s)
-                        writec+=1
-                    if (act_px+bpp)%s!=0:
-                        pxstack[writec]=(act_px+bpp)
-                        writec+=1
-                    if (act_px-bpp)%s!=s-bpp:
-                        pxstack[writec]=(act_px-bpp)
-                        writec+=1
+        rep_c = pixels.premultiplied_colour(pc)
+        self.bounds = fill.fill(surface, x, y, rep_c, self.canvas.fill_tolerance, self.canvas.fill_replace_all, selection,
+                                self.canvas.hold_tiles)
         self.mode = self.READY
 
+    def get_damage(self):
+        #the fill is done in begin, report it once
+        bounds = self.bounds
+        self.bounds = region.EMPTY
+        return bounds
+
 class PencilTool(DragAndDropTool):
     points = None
     name = 'Pencil'
+    line_width = 2
+    n_damaged = 0
+    # Coverage of the stroke so far, the new segments are added to it as the
+    # points arrive and the colour is painted through it as a mask.
+    layer = None
+    layer_bounds = region.EMPTY
+    n_drawn = 0
 
     def set_cursor(self):
         self.CURSOR = gtk.gdk.Cursor(gtk.gdk.PENCIL)
@@ -276,33 +308,73 @@ class PencilTool(DragAndDropTool):
         DragAndDropTool.begin(self, x, y,button)
         self.points = list()
         self.points.insert(len(self.points), (x, y))
+        self.n_damaged = 0
+        self.layer = self.canvas.buffers.get("stroke", self.canvas.width, self.canvas.height, cairo.FORMAT_A8)
+        self.layer_bounds = region.EMPTY
+        self.n_drawn = 0
+        self.rasterise()
 
     def move(self, x, y):
         if self.mode == self.DRAWING:
             self.points.insert(len(self.points), (x, y))
+            self.rasterise()
 
     def end(self, x, y):
         self.points.insert(len(self.points), (x, y))
+        self.rasterise()
 
-    def draw(self, context):
-        if self.mode == self.READY:
-            return
-
+    def set_stroke_style(self, context):
         context.set_antialias(cairo.ANTIALIAS_NONE)
         context.set_line_cap(cairo.LINE_CAP_ROUND)
         context.set_line_join(cairo.LINE_JOIN_ROUND)
-        context.move_to(self.initial_x, self.initial_y)
-        if self.m_button==3:
-            self.use_secondary_color(context)
-        else:
-            self.use_primary_color(context)
-
-        for point in self.points:
+        context.set_line_width(self.line_width)
+
+    def use_stroke_color(self, context):
+        self.use_primary_color(context, self.m_button)
+
+    def rasterise(self):
+        #add the segments appended since the last call to the stroke layer
+        start = max(self.n_drawn-1, 0)
+        points = self.points[start:]
+        self.n_drawn = len(self.points)
+        context = cairo.Context(self.layer)
+        self.set_stroke_style(context)
+        context.move_to(points[0][0], points[0][1])
+        for point in points:
             context.line_to(point[0], point[1])
+        context.set_source_rgba(0, 0, 0, 1)
         context.stroke()
+        self.layer_bounds = region.union(self.layer_bounds, region.from_points(points, self.get_damage_pad()))
+
+    def commit(self):
+        DragAndDropTool.commit(self)
+        #leave the shared layer clean for the next stroke
+        context = cairo.Context(self.layer)
+        context.rectangle(*self.layer_bounds)
+        context.set_operator(cairo.OPERATOR_CLEAR)
+        context.fill()
+        self.layer_bounds = region.EMPTY
+
+    def get_damage_pad(self):
+        return self.line_width/2.0+1
+
+    def get_damage(self):
+        #Only the segments added since the last repaint have changed
+        points = self.points[max(self.n_damaged-1, 0):]
+        self.n_damaged = len(self.points)
+        return region.from_points(points, self.get_damage_pad())
+
+    def draw(self, context):
+        if self.mode == self.READY:
+            return
+        #the layer already holds the whole stroke, so the cost doesn't grow
+        #with its length
+        self.use_stroke_color(context)
+        context.mask_surface(self.layer, 0, 0)
 
 class EraserTool(PencilTool):
     name = 'Eraser'
+    line_width = 8
 
     def set_cursor(self):
         pm = gtk.gdk.Pixmap(None,10,10,1)
@@ -319,108 +391,177 @@ class EraserTool(PencilTool):
         self.points.insert(len(self.points), (x, y+4))
         self.points.insert(len(self.points), (x, y-4))
         self.points.insert(len(self.points), (x, y))
+        self.rasterise()
+
+    def set_stroke_style(self, context):
+        #segments are drawn separately, square caps fill in the corners
+        #between them
+        context.set_antialias(cairo.ANTIALIAS_NONE)
+        context.set_line_cap(cairo.LINE_CAP_SQUARE)
+        context.set_line_join(cairo.LINE_JOIN_BEVEL)
+        context.set_line_width(self.line_width)
+
+    def use_stroke_color(self, context):
+        self.use_secondary_color(context, self.m_button)
+
+    def get_damage_pad(self):
+        #square caps reach out diagonally
+        return 0.75*self.line_width+1
 
     def draw(self, context):
         if self.mode == self.READY:
             return
-
-        context.set_antialias(cairo.ANTIALIAS_NONE)
-        context.set_line_cap(cairo.LINE_CAP_BUTT)
-        context.set_line_join(cairo.LINE_JOIN_MITER)
-        context.move_to(self.initial_x, self.initial_y)
-        context.set_line_width(8)
-        self.use_secondary_color(context,self.m_button)
-        for point in self.points:
-            context.line_to(point[0], point[1])
+        self.use_stroke_color(context)
         context.set_operator(cairo.OPERATOR_SOURCE)
-        context.stroke()
+        context.mask_surface(self.layer, 0, 0)
 
 class PaintbrushTool(PencilTool):
     name = 'PaintBrush'
+    line_width = 8
 
     def set_cursor(self):
         self.set_cursor_from_file('Cursors/cursor-paintbrush.png',18,35)
 
-    def draw(self, context):
-        if self.mode == self.READY:
-            return
-
+    def set_stroke_style(self, context):
         context.set_line_cap(cairo.LINE_CAP_ROUND)
         context.set_line_join(cairo.LINE_JOIN_ROUND)
-        context.move_to(self.initial_x, self.initial_y)
-        context.set_line_width(8)
-        self.use_primary_color(context,self.m_button)
-        for point in self.points:
-            context.line_to(point[0], point[1])
-        context.stroke()
+        context.set_line_width(self.line_width)
 
-class AirBrushTool(PencilTool):
+class AirBrushTool(DragAndDropTool):
     name = 'AirBrush'
-    Brush = None
-    Brush_off = None
-    Brush_rep = None
-    scale = None
+    BRUSH = "Brushes/AirBrush.png"
+    stamper = None
 
     def set_cursor(self):
         self.set_cursor_from_file('Cursors/cursor-airbrush.png',20,35)
 
     def begin(self, x, y,button):
-        super(AirBrushTool, self).begin(x, y,button)
-        self.Brush = cairo.ImageSurface.create_from_png("Brushes/AirBrush.png")
+        DragAndDropTool.begin(self, x, y,button)
         if button==3:
             pc=self.canvas.secondary
         else:
             pc = self.canvas.primary
-        a = pc.get_alpha()
-        r = pc.get_red()
-        g = pc.get_green()
-        b = pc.get_blue()
-        Brush_w = self.Brush.get_width()
-        self.Brush_off =  Brush_w/2.0
-        self.Brush_rep =  Brush_w/10
-        data = self.Brush.get_data()
-        for n in range(Brush_w**2):
-            al_bin = data[n*4+3]
-            al_int = struct.unpack_from(str(1)+'B',al_bin)
-            al = float(al_int[0])/255
-            px = create_string_buffer(4)
-            alph = al*a
-            struct.pack_into(str(4)+'B',px,0,int(alph*b*255), int(alph*g*255),int(alph*r*255), int(alph*255))
-            data[n*4:(n+1)*4] = px
-        self.scale =  self.canvas.airbrush_width/Brush_w
+        c = self.canvas
+        #dabs go straight onto the image as the pointer moves
+        self.stamper = brushes.StampBrush(c.brushes, self.BRUSH, c.airbrush_width,
+                                          c.airbrush_spacing, c.airbrush_hardness, c.airbrush_opacity)
+        self.stamper.begin(c.surface, pc, x, y, c.hold_tiles)
 
+    def move(self, x, y):
+        if self.mode == self.DRAWING:
+            self.stamper.stroke_to(x, y)
+
+    def end(self, x, y):
+        DragAndDropTool.end(self, x, y)
+        self.stamper.stroke_to(x, y)
+
+    def get_damage(self):
+        #the dabs made since the last call
+        if self.stamper is None:
+            return region.EMPTY
+        return self.stamper.damage.take()
+
+
+class FloatingPasteTool(DragAndDropTool):
+    # A pasted image held above the canvas until it is placed. Dragging it
+    # moves it, a click anywhere else paints it into the image and goes back
+    # to the tool that was in use before. Until then it is only drawn on the
+    # overlay, so moving it leaves the image and its tiles alone.
+    name = 'FloatingPaste'
+    Draw2Overlay = True
+    layer = None
+    x = 0
+    y = 0
+    grab = None
+    resume_tool = None
+    #where the layer was last drawn on the overlay
+    drawn_bounds = region.EMPTY
+
+    def set_cursor(self):
+        self.CURSOR = gtk.gdk.Cursor(gtk.gdk.FLEUR)
+
+    def hold(self, layer, x, y, resume_tool):
+        self.layer = layer
+        self.x = x
+        self.y = y
+        self.resume_tool = resume_tool
+        self.last_bounds = region.EMPTY
+        self.drawn_bounds = region.EMPTY
+        self.mode = self.EDITING
+
+    def begin(self, x, y,button):
+        if self.layer is None:
+            return
+        if region.is_empty(region.intersect(self.get_bounds(), (int(x), int(y), 1, 1))):
+            self.place()
+            return
+        self.mode = self.DRAWING
+        self.grab = (x-self.x, y-self.y)
 
     def move(self, x, y):
         if self.mode == self.DRAWING:
-            xd = x-self.points[-1][0]
-            yd = y-self.points[-1][1]
-            dist = (((xd)**2 + (yd)**2)**0.5)/self.scale
-            if dist>self.Brush_rep:
-                n = int(dist/self.Brush_rep)
-                xd /= n
-                yd /= n
-                x = self.points[-1][0]
-                y = self.points[-1][1]
-                self.points = list()
-                for i in range(n):
-                    x+=xd
-                    y+=yd
-                    self.points.insert(len(self.points), (x, y))
-            else:
-                self.points = list()
-                self.points.insert(len(self.points), (x, y))
+            #whole pixel positions keep the layer from being resampled
+            self.x = int(round(x-self.grab[0]))
+            self.y = int(round(y-self.grab[1]))
+
+    def end(self, x, y):
+        self.move(x, y)
+        self.mode = self.EDITING
+
+    def commit(self):
+        if self.layer is None:
+            self.mode = self.READY
+            self.canvas.previous_tool = self.resume_tool
+
+    def place(self):
+        #paint the layer into the image where it is
+        if self.layer is None:
+            return
+        self.canvas.begin_undo_step()
+        bounds = self.get_bounds()
+        self.canvas.hold_tiles(bounds)
+        context = cairo.Context(self.canvas.surface)
+        context.set_source_surface(self.layer, self.x, self.y)
+        context.paint()
+        self.layer = None
+        self.canvas.commit_image(bounds)
+        #it is part of the image now, take it off the overlay
+        context = cairo.Context(self.canvas.overlay)
+        self.__wipe(context, self.drawn_bounds)
+        self.drawn_bounds = region.EMPTY
+        self.canvas.add_damage(bounds)
+
+    def get_bounds(self):
+        if self.layer is None:
+            return region.EMPTY
+        return (self.x, self.y, self.layer.get_width(), self.layer.get_height())
 
     def draw(self, context):
-        if self.mode == self.READY:
+        #only where the layer was and where it goes are drawn on the overlay
+        if self.layer is None:
             return
-        context.scale(self.scale,self.scale)
-        for n in range(len(self.points)):
-            context.set_source_surface(self.Brush, (self.points[n][0])/self.scale-self.Brush_off, (self.points[n][1])/self.scale-self.Brush_off)
-            context.paint()
+        bounds = self.get_bounds()
+        self.__wipe(context, region.union(self.drawn_bounds, bounds))
+        self.drawn_bounds = bounds
+        context.set_source_surface(self.layer, self.x, self.y)
+        context.paint()
+
+    def __wipe(self, context, rect):
+        if region.is_empty(rect):
+            return
+        context.save()
+        context.set_operator(cairo.OPERATOR_CLEAR)
+        context.rectangle(*rect)
+        context.fill()
+        context.restore()
 
 
 class StraightLineTool(DragAndDropTool):
     name = 'StraightLine';
+    def get_bounds(self):
+        #cairo's default line width is 2
+        return region.from_corners(self.initial_x, self.initial_y, self.final_x, self.final_y, 2)
+
     def draw(self, context):
         if self.mode == self.READY:
             return
@@ -431,7 +572,13 @@ class StraightLineTool(DragAndDropTool):
         context.stroke()
 
 
-class RectangleTool(DragAndDropTool):
+class FigureTool(DragAndDropTool):
+    def get_bounds(self):
+        pad = self.canvas.figure_linewidth/2.0+1
+        return region.from_corners(self.initial_x, self.initial_y, self.final_x, self.final_y, pad)
+
+
+class RectangleTool(FigureTool):
     name = 'Rectangle'
     def draw(self, context):
         if self.mode == self.READY:
@@ -447,7 +594,7 @@ class RectangleTool(DragAndDropTool):
         context.stroke()
 
 
-class RoundedRectangleTool(DragAndDropTool):
+class RoundedRectangleTool(FigureTool):
     name = 'RoundedRectangle'
     def draw(self, context):
         if self.mode == self.READY:
@@ -496,7 +643,7 @@ class RoundedRectangleTool(DragAndDropTool):
             context.arc_negative(x,y,R,a1,a)
         return a
 
-class EllipseTool(DragAndDropTool):
+class EllipseTool(FigureTool):
     name = 'Ellipse'
     def draw(self, context):
         if self.mode == self.READY:
@@ -531,6 +678,9 @@ class RectangleSelectTool(DragAndDropTool):
     Draw2Overlay = True
     w=None
     h=None
+    #the box last drawn on the overlay, get_damage moves last_bounds on
+    #before it is redrawn
+    drawn_bounds = region.EMPTY
 
     def begin(self, x, y,button):
         self.canvas.clear_overlay()
@@ -540,6 +690,11 @@ class RectangleSelectTool(DragAndDropTool):
         self.initial_y = y
         self.final_x = x
         self.final_y = y
+        self.last_bounds = region.EMPTY
+        self.drawn_bounds = region.EMPTY
+
+    def get_bounds(self):
+        return region.from_corners(self.initial_x, self.initial_y, self.final_x, self.final_y, 2)
 
     def draw(self,context):
         if self.mode == self.READY:
@@ -547,13 +702,16 @@ class RectangleSelectTool(DragAndDropTool):
         self.w = self.final_x - self.initial_x
         self.h = self.final_y - self.initial_y
         if abs(self.w)>0 and abs(self.h)>0:
-            context.set_operator(cairo.OPERATOR_SOURCE)
-            context.set_line_width(1)
-            context.set_antialias(cairo.ANTIALIAS_NONE)
-            context.rectangle(0, 0, self.canvas.width, self.canvas.height)
-            context.set_source_rgba(0, 0, 0, 0)
+            #only wipe the old box and where the new one goes
+            bounds = self.get_bounds()
+            clear = region.union(self.drawn_bounds, bounds)
+            self.drawn_bounds = bounds
+            context.set_operator(cairo.OPERATOR_CLEAR)
+            context.rectangle(*clear)
             context.fill()
             context.set_operator(cairo.OPERATOR_OVER)
+            context.set_line_width(1)
+            context.set_antialias(cairo.ANTIALIAS_NONE)
             context.rectangle(self.initial_x, self.initial_y, self.w, self.h)
             context.set_dash((5,5))
             context.set_source_rgba(0,0,1,1)
@@ -568,8 +726,124 @@ class RectangleSelectTool(DragAndDropTool):
     def commit(self):
         self.mode = self.READY
         if abs(self.w)>0 and abs(self.h)>0:
-            self.canvas.set_selection(True)
-            self.canvas.select_xp = [self.initial_x,self.initial_x,self.final_x,self.final_x]
-            self.canvas.select_yp = [self.initial_y,self.final_y,self.initial_y,self.final_y]
+            x = int(min(self.initial_x, self.final_x))
+            y = int(min(self.initial_y, self.final_y))
+            w = int(max(self.initial_x, self.final_x))-x
+            h = int(max(self.initial_y, self.final_y))-y
+            self.canvas.set_selection(Selection.from_rect((x, y, w, h)))
+        else:
+            self.canvas.set_selection(None)
+
+
+class MagicWandTool(Tool):
+    name = 'MagicWand'
+    Draw2Overlay = True
+    selection = None
+    shown = None
+    tint_mask = None
+
+    def set_cursor(self):
+        self.CURSOR = gtk.gdk.Cursor(gtk.gdk.CROSSHAIR)
+
+    def begin(self, x, y,button):
+        self.canvas.clear_overlay()
+        #don't update undo buffer
+        self.mode = self.DRAWING
+        self.selection = Selection.from_colour(self.canvas.get_image(), x, y, self.canvas.fill_tolerance)
+        self.shown = None
+        if not self.selection.is_empty():
+            self.tint_mask = self.selection.to_surface()
+
+    def get_bounds(self):
+        if self.selection is None:
+            return region.EMPTY
+        return self.selection.get_bounds()
+
+    def get_damage(self):
+        #the selection only has to be shown once
+        if self.shown is self.selection:
+            return region.EMPTY
+        self.shown = self.selection
+        return self.get_bounds()
+
+    def draw(self, context):
+        if self.mode == self.READY or self.selection.is_empty():
+            return
+        x, y, w, h = self.selection.get_bounds()
+        #tint the selected pixels and box them in
+        context.save()
+        context.rectangle(x, y, w, h)
+        context.clip()
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.set_source_rgba(0, 0, 0, 0)
+        context.paint()
+        context.set_source_rgba(0, 0, 1, 0.3)
+        context.mask_surface(self.tint_mask, x, y)
+        context.restore()
+        context.set_line_width(1)
+        context.set_antialias(cairo.ANTIALIAS_NONE)
+        context.rectangle(x+0.5, y+0.5, w-1, h-1)
+        context.set_dash((5,5))
+        context.set_source_rgba(0,0,1,1)
+        context.stroke_preserve()
+        context.set_dash((5,5),5)
+        context.set_source_rgba(1,1,0,1)
+        context.stroke()
+
+    def commit(self):
+        self.mode = self.READY
+        self.canvas.set_selection(self.selection)
+        if not self.canvas.select_active:
+            self.canvas.clear_overlay()
+
+
+class FreeSelectTool(DragAndDropTool):
+    name = 'FreeSelect'
+    Draw2Overlay = True
+    points = None
+
+    def begin(self, x, y,button):
+        self.canvas.clear_overlay()
+        #don't update undo buffer
+        self.mode = self.DRAWING
+        self.points = [(x, y)]
+        self.last_bounds = region.EMPTY
+
+    def move(self, x, y):
+        if self.mode == self.DRAWING:
+            self.points.append((x, y))
+
+    def end(self, x, y):
+        Tool.end(self, x, y)
+        self.points.append((x, y))
+
+    def get_bounds(self):
+        return region.from_points(self.points, 2)
+
+    def draw(self, context):
+        if self.mode == self.READY:
+            return
+        context.set_line_width(1)
+        context.set_antialias(cairo.ANTIALIAS_NONE)
+        context.move_to(*self.points[0])
+        for point in self.points[1:]:
+            context.line_to(*point)
+        #the outline is closed once the button is let go
+        if self.mode != self.DRAWING:
+            context.close_path()
+        context.set_dash((5,5))
+        context.set_source_rgba(0,0,1,1)
+        context.stroke_preserve()
+        context.set_dash((5,5),5)
+        context.set_source_rgba(1,1,0,1)
+        context.stroke()
+
+    def commit(self):
+        self.mode = self.READY
+        clip = (0, 0, self.canvas.width, self.canvas.height)
+        if len(self.points) > 2:
+            self.canvas.set_selection(Selection.from_polygon(self.points, clip))
         else:
-            self.canvas.set_selection(False)
\ No newline at end of file
+            self.canvas.set_selection(None)
+        if not self.canvas.select_active:
+            self.canvas.clear_overlay()
\ No newline at end of file
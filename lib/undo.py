@@ -0,0 +1,375 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import zlib
+import threading
+import Queue
+import mmap
+import tempfile
+from tiles import is_shared
+
+# Bytes of tiles the history may hold before the oldest steps are dropped
+DEFAULT_BUDGET = 256*1024*1024
+# Fast zlib level, undo tiles are mostly flat colour and squash well anyway
+COMPRESS_LEVEL = 1
+
+class CompressedTile:
+    # A tile the history no longer needs at hand, kept zlib compressed
+    data = None
+    raw_size = None
+
+    def __init__(self, tile):
+        self.data = zlib.compress(tile, COMPRESS_LEVEL)
+        self.raw_size = len(tile)
+
+    def __len__(self):
+        return len(self.data)
+
+    def expand(self):
+        return zlib.decompress(self.data)
+
+class JournalTile:
+    # A tile moved out of memory into the undo journal
+    journal = None
+    offset = None
+    length = None
+    compressed = None
+
+    def __init__(self, journal, tile):
+        self.journal = journal
+        self.compressed = isinstance(tile, CompressedTile)
+        if self.compressed:
+            tile = tile.data
+        self.offset = journal.write(tile)
+        self.length = len(tile)
+
+    def __len__(self):
+        #only the pages being read are resident
+        return 0
+
+    def expand(self):
+        data = self.journal.read(self.offset, self.length)
+        if self.compressed:
+            return zlib.decompress(data)
+        return data
+
+def expand(tile):
+    if isinstance(tile, (CompressedTile, JournalTile)):
+        return tile.expand()
+    return tile
+
+class UndoJournal:
+    # Append only temporary file mapped into memory, the OS pages tiles in
+    # when they are read back and can drop them again when memory is short.
+    GROW = 64*1024*1024
+    file = None
+    map = None
+    used = None
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(prefix='dappy-undo-')
+        self.used = 0
+
+    def write(self, data):
+        offset = self.used
+        end = offset+len(data)
+        if self.map is None:
+            self.file.truncate(max(end, self.GROW))
+            self.map = mmap.mmap(self.file.fileno(), max(end, self.GROW))
+        elif end > len(self.map):
+            self.map.resize(max(end, len(self.map)+self.GROW))
+        self.map[offset:end] = data
+        self.used = end
+        return offset
+
+    def read(self, offset, length):
+        return self.map[offset:offset+length]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+class Compressor(threading.Thread):
+    # Compresses batches of tiles off the main thread (zlib lets go of the
+    # GIL while it works) and hands the results to done().
+    def __init__(self, done):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.done = done
+        self.queue = Queue.Queue()
+
+    def add(self, tiles):
+        self.queue.put(tiles)
+
+    def run(self):
+        while True:
+            tiles = self.queue.get()
+            self.done([(tile, CompressedTile(tile)) for tile in tiles])
+
+class UndoStep:
+    # One edit: the tiles it changed as they were before and after, and the
+    # image size either side of it.
+    before = None
+    after = None
+    before_size = None
+    after_size = None
+
+    def __init__(self, size):
+        self.before = {}
+        self.after = {}
+        self.before_size = size
+        self.after_size = size
+
+    def merge(self, changes, size):
+        #add more changes made by the same edit
+        for key, (old, new) in changes.iteritems():
+            if key not in self.before:
+                self.before[key] = old
+            self.after[key] = new
+        self.after_size = size
+
+    def is_empty(self):
+        return not self.after and self.before_size == self.after_size
+
+    def get_tiles(self):
+        return self.before.values()+self.after.values()
+
+    def copy(self):
+        #the tiles are shared, later changes to either step's index are not
+        step = UndoStep(self.before_size)
+        step.after_size = self.after_size
+        step.before = dict(self.before)
+        step.after = dict(self.after)
+        return step
+
+class UndoHistory:
+    # held maps id(tile) to [tile, places] for every tile the history holds,
+    # places being the (step, side, key) it is found at, so memory_size can
+    # be kept up to date as tiles come and go rather than recounted. Steps
+    # before spilled have been moved to the journal. newest is the step edits
+    # are still merged into and counted what was counted of it.
+    budget = None
+    steps = None
+    redos = None
+    memory_size = None
+    held = None
+    spilled = None
+    newest = None
+    counted = None
+    compressor = None
+    queued = None
+    call_in_main = None
+    journal = None
+
+    def __init__(self, budget=DEFAULT_BUDGET, call_in_main=None, journal=None):
+        # call_in_main(function, args) must run function on the main thread
+        # later (eg. gobject.idle_add), without it nothing is compressed.
+        # With a journal, steps over the budget are moved to it rather than
+        # being forgotten.
+        self.budget = budget
+        self.call_in_main = call_in_main
+        self.journal = journal
+        self.clear()
+
+    def clear(self):
+        self.steps = []
+        self.redos = []
+        self.memory_size = 0
+        self.held = {}
+        self.spilled = 0
+        self.newest = None
+        self.counted = {}
+        self.queued = set()
+        if self.journal is not None and self.journal.used:
+            #copies of steps being saved may still read the old journal, it
+            #is closed once nothing refers to it
+            self.journal = UndoJournal()
+
+    def restore(self, steps, redos):
+        #take on a history saved with the image
+        self.clear()
+        self.steps = steps
+        self.redos = redos
+        for step in steps+redos:
+            self.__hold_step(step)
+        self.update()
+
+    def snapshot(self):
+        #(steps, redos) as they are now, for saving in the background
+        return ([step.copy() for step in self.steps], [step.copy() for step in self.redos])
+
+    def push(self, step):
+        #a new edit makes the undone steps unreachable
+        for old in self.redos:
+            self.__release_step(old)
+        self.redos = []
+        self.steps.append(step)
+        self.newest = step
+        self.counted = {}
+        self.update()
+
+    def update(self):
+        #count what the newest step has gained and keep within the budget,
+        #always keeping the newest step
+        if self.newest is not None:
+            self.__count_newest()
+        while self.memory_size > self.budget and len(self.steps) > 1:
+            if self.journal is None:
+                self.__release_step(self.steps.pop(0))
+            elif self.spilled < len(self.steps)-1:
+                self.__spill(self.steps[self.spilled])
+                self.spilled += 1
+            else:
+                break
+
+    def __hold(self, tile, place):
+        #shared tiles are counted too, the uniform tile cache only keeps
+        #some of them and the rest are held for as long as undo holds them
+        if tile is None:
+            return
+        held = self.held.get(id(tile))
+        if held is None:
+            self.held[id(tile)] = [tile, [place]]
+            self.memory_size += len(tile)
+        else:
+            held[1].append(place)
+
+    def __release(self, tile, place):
+        if tile is None:
+            return
+        held = self.held[id(tile)]
+        held[1].remove(place)
+        if not held[1]:
+            del self.held[id(tile)]
+            self.memory_size -= len(tile)
+
+    def __hold_step(self, step):
+        for side, changed in ((0, step.before), (1, step.after)):
+            for key, tile in changed.iteritems():
+                self.__hold(tile, (step, side, key))
+
+    def __release_step(self, step):
+        for side, changed in ((0, step.before), (1, step.after)):
+            for key, tile in changed.iteritems():
+                self.__release(tile, (step, side, key))
+
+    def __count_newest(self):
+        #merging only adds keys or changes tiles of the newest step
+        step = self.newest
+        for side, changed in ((0, step.before), (1, step.after)):
+            for key, tile in changed.iteritems():
+                place = (side, key)
+                if place not in self.counted:
+                    self.__hold(tile, (step, side, key))
+                elif self.counted[place] is not tile:
+                    self.__release(self.counted[place], (step, side, key))
+                    self.__hold(tile, (step, side, key))
+                else:
+                    continue
+                self.counted[place] = tile
+
+    def __replace(self, step, side, key, tile):
+        changed = (step.before, step.after)[side]
+        self.__release(changed[key], (step, side, key))
+        changed[key] = tile
+        self.__hold(tile, (step, side, key))
+        if step is self.newest:
+            self.counted[(side, key)] = tile
+
+    def __spill(self, step):
+        #move a step's tiles into the journal, tiles shared by both sides
+        #are only written once
+        written = {}
+        for side, changed in ((0, step.before), (1, step.after)):
+            for key, tile in changed.items():
+                if is_shared(tile) or isinstance(tile, JournalTile):
+                    continue
+                if id(tile) not in written:
+                    written[id(tile)] = JournalTile(self.journal, tile)
+                self.__replace(step, side, key, written[id(tile)])
+
+    def compress_old(self, image):
+        # Queue the tiles of the newest step that are not part of the current
+        # image for compression, the image's own tiles are held uncompressed
+        # there anyway. Older steps had theirs queued when they were newest.
+        if self.call_in_main is None or self.newest is None:
+            return
+        tiles = []
+        for changed in (self.newest.before, self.newest.after):
+            for key, tile in changed.iteritems():
+                if isinstance(tile, (CompressedTile, JournalTile)) or is_shared(tile) or id(tile) in self.queued:
+                    continue
+                if image.get_tile(key) is not tile:
+                    self.queued.add(id(tile))
+                    tiles.append(tile)
+        if tiles:
+            if self.compressor is None:
+                self.compressor = Compressor(self.__compressed)
+                self.compressor.start()
+            self.compressor.add(tiles)
+
+    def __compressed(self, results):
+        #runs on the worker thread
+        self.call_in_main(self.store_compressed, results)
+
+    def store_compressed(self, results):
+        #swap the compressed tiles in wherever the originals are still held
+        for tile, small in results:
+            self.queued.discard(id(tile))
+            held = self.held.get(id(tile))
+            if held is None or held[0] is not tile:
+                continue
+            for step, side, key in list(held[1]):
+                self.__replace(step, side, key, small)
+        self.update()
+        return False
+
+    def get_compression_stats(self):
+        #(bytes before compression, bytes after) for the compressed tiles held
+        raw = 0
+        packed = 0
+        for tile, places in self.held.itervalues():
+            if isinstance(tile, CompressedTile):
+                raw += tile.raw_size
+                packed += len(tile)
+        return (raw, packed)
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.update()
+
+    def can_undo(self):
+        return len(self.steps) > 0
+
+    def can_redo(self):
+        return len(self.redos) > 0
+
+    def undo(self):
+        step = self.steps.pop()
+        self.redos.append(step)
+        self.newest = None
+        self.spilled = min(self.spilled, len(self.steps))
+        return step
+
+    def redo(self):
+        step = self.redos.pop()
+        self.steps.append(step)
+        self.newest = None
+        return step
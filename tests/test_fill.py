@@ -0,0 +1,63 @@
+#    This file is part of Dappy - Draw And Paint in Python
+#    Copyright (C) 2015 Julian Stirling
+#
+#    Dappy was forked from Painthon, listed on Google code as GPL v2,
+#    copyright holder unknown.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+import cairo
+import pixels
+from fill import fill
+from selection import Selection
+
+BLUE = (255, 0, 0, 255)
+
+class FillInSelectionTest(unittest.TestCase):
+    # A selection narrower than the image makes the pixels looked at a
+    # sub-rectangle of the surface rather than whole rows
+
+    def setUp(self):
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 64, 48)
+        self.selection = Selection.from_rect((10, 5, 20, 30))
+
+    def check_filled(self, bounds):
+        self.assertEqual(bounds, (10, 5, 20, 30))
+        array = pixels.surface_array(self.surface)
+        self.assertTrue((array[5:35, 10:30] == BLUE).all())
+        #nothing outside the selection is touched
+        array[5:35, 10:30] = 0
+        self.assertFalse(array.any())
+
+    def test_fill(self):
+        self.check_filled(fill(self.surface, 15, 10, BLUE, selection=self.selection))
+
+    def test_fill_with_tolerance(self):
+        self.check_filled(fill(self.surface, 15, 10, BLUE, 8, selection=self.selection))
+
+    def test_replace_all(self):
+        self.check_filled(fill(self.surface, 15, 10, BLUE, replace_all=True, selection=self.selection))
+
+    def test_outside_selection(self):
+        self.assertEqual(fill(self.surface, 40, 10, BLUE, selection=self.selection), (0, 0, 0, 0))
+        self.assertFalse(pixels.surface_array(self.surface).any())
+
+if __name__ == "__main__":
+    unittest.main()